@@ -17,14 +17,20 @@ __title__ = 'AQM test framework'
 __author__ = 'Henrik Steen'
 
 from datetime import datetime, timezone
+import functools
 import os
 import sys
 import socket
 
 from . import traffic
 from . import steps
+from . import journal
 from . import logger
+from . import runtime
+from . import testplan
+from . import timeline
 from .plot import plot_test
+from .reanalyze import analyze_folder
 from .testcollection import TestCollection
 from .testbed import Testbed, require_on_aqm_node
 from .testenv import TestEnv
@@ -47,10 +53,13 @@ class Testdef:
         }
 
     def testcase_analyze(self, testcase, samples_to_skip):
-        analyze_test(testcase.test_folder, samples_to_skip)
+        return analyze_test(testcase.test_folder, samples_to_skip,
+                            detect_steady_state=self.testenv.detect_steady_state)
 
-    def testcase_plot(self, testcase):
-        for name, plot_args in self.test_plots.items():
+    def testcase_plot(self, testcase, test_plots=None):
+        if test_plots is None:
+            test_plots = self.test_plots
+        for name, plot_args in test_plots.items():
             plot_test(testcase.test_folder, name=name, **plot_args)
 
 
@@ -68,33 +77,51 @@ def run_test(folder=None, testenv=None, title=None, subtitle=None, steps=None,
     # We use this to hold internal parameters.
     testenv.testdef = testdef
 
+    # the journal is used to resume a campaign, also in the dry run
+    testenv.journal = journal.Journal(folder)
+
+    testenv.runtime_history = runtime.RuntimeHistory()
+    for history_folder in [folder] + testenv.history_folders:
+        testenv.runtime_history.add_folder(history_folder)
+
     num_tests = 0
     estimated_time = 0
     num_tests_total = 0
+    plan = []  # the tests found in the dry run
 
-    def get_metadata(testcollection, testenv):
+    def get_metadata(testcollection, testenv, test_fn):
         nonlocal estimated_time, num_tests, num_tests_total
-        meta = testcollection.get_metadata(testenv)
+        meta = testcollection.get_metadata(testenv, test_fn)
         estimated_time += meta['estimated_time'] if meta['will_test'] else 0
         num_tests += 1 if meta['will_test'] else 0
         num_tests_total += 1
+        return meta
 
     def walk(parent, steps, level=0):
         testdef.collection = parent
 
         # The last step should be the actual traffic generator
         if len(steps) == 1:
+            run_args = {
+                'test_fn': steps[0],
+                'testenv': testenv,
+                'analyze_fn': testdef.testcase_analyze,
+                # the plots might change before a test is plotted in the background
+                'plot_fn': functools.partial(testdef.testcase_plot, test_plots=dict(testdef.test_plots)),
+                'pre_hook': testdef.pre_hook,
+                'post_hook': testdef.post_hook,
+            }
+
             if testdef.dry_run:
-                get_metadata(parent, testenv)
+                meta = get_metadata(parent, testenv, steps[0])
+                plan.append(testplan.PlannedTest(parent, run_args, testplan.get_state(testenv),
+                                                 meta['estimated_time'], meta['will_test']))
+            elif testenv.scheduler is not None:
+                meta = parent.get_metadata(testenv, steps[0])
+                parent.plan_test(testplan.PlannedTest(parent, run_args, testplan.get_state(testenv),
+                                                      meta['estimated_time'], meta['will_test']))
             else:
-                parent.run_test(
-                    test_fn=steps[0],
-                    testenv=testenv,
-                    analyze_fn=testdef.testcase_analyze,
-                    plot_fn=testdef.testcase_plot,
-                    pre_hook=testdef.pre_hook,
-                    post_hook=testdef.post_hook,
-                )
+                parent.run_test(**run_args)
 
         else:
             # Each step should be a generator, yielding metadata for new branches.
@@ -111,7 +138,9 @@ def run_test(folder=None, testenv=None, title=None, subtitle=None, steps=None,
                         title=step['title'],
                         titlelabel=step['titlelabel'],
                         folder=step['tag'],
-                        parent=parent
+                        parent=parent,
+                        hints=step.get('hints'),
+                        dynamic=step.get('dynamic', False),
                     )
                 walk(child, steps[1:], level + 1)
 
@@ -127,8 +156,15 @@ def run_test(folder=None, testenv=None, title=None, subtitle=None, steps=None,
 
     testdef.dry_run = True
     walk(get_root(), steps)
-    print('Estimated time: %d seconds for running %d (of %d) tests (average %g sec/test)\n' % (
-        estimated_time, num_tests, num_tests_total, estimated_time / num_tests if num_tests > 0 else 0))
+    print('Estimated time: %d seconds for running %d (of %d) tests (average %g sec/test, history of %d tests)\n' % (
+        estimated_time, num_tests, num_tests_total, estimated_time / num_tests if num_tests > 0 else 0,
+        testenv.runtime_history.num_tests))
+
+    if testenv.scheduler is not None:
+        applied_config = testenv.testbed.get_applied_config()
+        print('Testbed reconfiguration cost: %d in order of steps, %d if all tests can be reordered\n' % (
+            testplan.get_plan_cost(plan, applied_config),
+            testplan.get_plan_cost(testenv.scheduler(plan, applied_config), applied_config)))
 
     if ask_confirmation is None:
         ask_confirmation = True
@@ -141,8 +177,38 @@ def run_test(folder=None, testenv=None, title=None, subtitle=None, steps=None,
         should_run_test = input().lower() == 'y'
 
     if should_run_test:
+        # the tests of dynamic branches will not be run as planned
+        planned = [test for test in plan if not test.is_dynamic()]
+
+        os.makedirs(folder, exist_ok=True)
+        testplan.save_plan(folder + '/plan.json', planned)
+        testenv.journal.start_campaign(testplan.get_plan_hash(planned), planned)
+        timeline.campaign_file = folder + '/' + timeline.TIMELINE_FILE
+
         testdef.dry_run = False
-        walk(get_root(), steps)
+        testenv.progress = runtime.CampaignProgress(plan)
+        if testenv.ssh_pool is not None:
+            testenv.ssh_pool.start()
+
+        try:
+            with timeline.span(None, 'campaign', 'campaign', results=folder):
+                root = get_root()
+                walk(root, steps)
+                root.run_pending_tests()
+
+                # the setup might be kept between tests, so leave the testbed reset
+                if testenv.testbed.is_setup_applied():
+                    testenv.testbed.reset()
+
+                root.wait_for_analysis()
+        finally:
+            # wait for analysis still running, e.g. if a test failed
+            if testenv.analysis_pool is not None:
+                testenv.analysis_pool.shutdown()
+                testenv.analysis_pool = None
+            if testenv.ssh_pool is not None:
+                testenv.ssh_pool.stop()
+            timeline.campaign_file = None
 
 
 # src: http://stackoverflow.com/a/40655575/4471194
@@ -0,0 +1,143 @@
+"""
+This module contains the connection to the traffic agent running
+on the clients and servers (bin/aqmt-traffic-agent)
+
+Instead of running local ssh processes for each flow, the flows of a
+node are sent in a batch to the agent over a single SSH connection,
+and the agent starts and stops them on the node. This makes it
+possible to run many flows without using a lot of local processes.
+
+The agent must be available on the nodes, see aqmt-update-nodes-data.
+"""
+
+import os
+import subprocess
+
+from . import logger
+from . import processes
+from .ssh import get_ssh
+from .testbed import TestbedError
+
+agents = {}  # node to TrafficAgent
+
+# number of requests sent before reading their replies, so the
+# replies of a large batch don't fill the pipe from the agent
+# while we are still writing to it
+REQUEST_CHUNK = 100
+
+
+class TrafficAgent:
+    def __init__(self, node):
+        self.node = node
+        self.next_id = 0
+        self.process = None
+
+    def connect(self):
+        cmd = get_ssh()[os.environ['IP_%s_MGMT' % self.node], 'aqmt-traffic-agent']
+        self.process = cmd.popen(stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+
+        # make sure the connection is closed if the test is aborted,
+        # which causes the agent to stop all flows
+        processes.add_known_pid(self.process.pid)
+        logger.debug('Connected to traffic agent on %s (PID: %d)' % (self.node, self.process.pid))
+
+    def request(self, lines):
+        """
+        Send a batch of requests and return the replies, one per request
+
+        The requests are sent in chunks, waiting for the replies
+        of each chunk before sending the next.
+        """
+        if self.process is None:
+            self.connect()
+
+        replies = []
+        for i in range(0, len(lines), REQUEST_CHUNK):
+            chunk = lines[i:i + REQUEST_CHUNK]
+            self.process.stdin.write(''.join(line + '\n' for line in chunk))
+            self.process.stdin.flush()
+
+            for line in chunk:
+                reply = self.process.stdout.readline()
+                if reply == '':
+                    raise TestbedError('Lost connection to traffic agent on %s' % self.node)
+                replies.append(reply.strip())
+
+        return replies
+
+    def start(self, commands):
+        """
+        Start a list of shell commands on the node
+
+        Returns the list of flow ids, used to stop the flows.
+        """
+        ids = []
+        lines = []
+        for command in commands:
+            if '\n' in command:
+                raise Exception('Commands for the traffic agent must be a single line')
+            ids.append('%d' % self.next_id)
+            lines.append('start %d %s' % (self.next_id, command))
+            self.next_id += 1
+
+        for reply in self.request(lines):
+            if not reply.startswith('started '):
+                raise Exception('Traffic agent on %s failed to start flow: %s' % (self.node, reply))
+
+        return ids
+
+    def stop(self, ids):
+        if self.process is not None and self.process.poll() is None:
+            self.request(['stop %s' % flow_id for flow_id in ids])
+
+    def get_status(self):
+        """
+        Get the state of all flows, as a dict of flow id to
+        'running' or 'exited <code>'
+        """
+        if self.process is None:
+            return {}
+
+        self.process.stdin.write('status\n')
+        self.process.stdin.flush()
+
+        status = {}
+        while True:
+            reply = self.process.stdout.readline().strip()
+            if reply == '' or reply == 'end':
+                break
+            _, flow_id, pid, state = reply.split(' ', 3)
+            status[flow_id] = state
+
+        return status
+
+    def close(self):
+        """
+        Close the connection, which stops all flows on the node
+        """
+        if self.process is None:
+            return
+
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+        self.process = None
+
+
+def get_agent(node):
+    """
+    Get the agent for a node, e.g. CLIENTA
+    """
+    if node not in agents:
+        agents[node] = TrafficAgent(node)
+    return agents[node]
+
+
+def close_agents():
+    for agent in agents.values():
+        agent.close()
+    agents.clear()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# this file generates flow completion time statistics for the short
+# transfers of the test (see short_flows in traffic.py), grouped by
+# the tag of the traffic and the size of the transfers
+#
+# the transfers are put in buckets by size, with a bucket for each
+# power of ten, e.g. 10000-99999 bytes
+#
+# the results are saved to:
+# - fct_stats
+
+from collections import OrderedDict
+import numpy as np
+import os
+import sys
+
+from aqmt.calc_tagged_rate import extract_properties, generate_stats
+from aqmt.testdata import TestData
+
+
+def get_fct_files(data):
+    """
+    Get a list of the files with completion times and their tag
+    """
+    metadata_kv, metadata_lines = data.get_details()
+
+    files = []
+    for key, value in metadata_lines:
+        if key.startswith('traffic='):
+            properties = extract_properties(key + ' ' + value)
+            if properties.get('type') == 'short':
+                files.append((data.folder + '/fct/' + properties['server'], properties['tag']))
+
+    return files
+
+
+def read_fct(file):
+    """
+    Read the transfers from a file, as an array of rows with
+    start time, size and completion time
+    """
+    rows = []
+    with open(file, 'r') as f:
+        for line in f:
+            # the file is written through a terminal so it
+            # might contain other output and carriage returns
+            parts = line.split()
+            if len(parts) != 3:
+                continue
+            try:
+                rows.append([float(part) for part in parts])
+            except ValueError:
+                continue
+
+    return np.array(rows).reshape(-1, 3)
+
+
+def get_buckets(sizes):
+    """
+    Get the lower limit of the bucket of each size
+    """
+    return np.power(10, np.floor(np.log10(np.maximum(sizes, 1)))).astype(int)
+
+
+def process_test(folder, time_to_skip, data=None):
+    """
+    time_to_skip: Seconds from the first transfer where
+    transfers are not included, while the test is starting
+    """
+    if data is None:
+        data = TestData(folder)
+
+    if not os.path.exists(folder + '/aggregated'):
+        os.makedirs(folder + '/aggregated')
+
+    transfers = OrderedDict()  # tag to list of arrays
+    for file, tag in get_fct_files(data):
+        if os.path.isfile(file):
+            transfers.setdefault(tag, []).append(read_fct(file))
+
+    with open(folder + '/aggregated/fct_stats', 'w') as fstats:
+        fstats.write('#tag size_from size_to transfers average stddev min p1 p25 p50 p75 p99 max\n')
+
+        for tag, arrays in transfers.items():
+            rows = np.concatenate(arrays)
+            if rows.shape[0] > 0:
+                rows = rows[rows[:, 0] >= rows[:, 0].min() + time_to_skip]
+
+            buckets = get_buckets(rows[:, 1])
+            for bucket in np.unique(buckets):
+                fcts = rows[buckets == bucket, 2]
+                fstats.write('"%s" %d %d %d %s\n' % (tag, bucket, bucket * 10 - 1, fcts.size, generate_stats(fcts)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: %s <test_folder> [<seconds_to_skip>]' % sys.argv[0])
+        sys.exit(1)
+    process_test(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 0)
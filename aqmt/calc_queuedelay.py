@@ -9,89 +9,103 @@ import numpy as np
 import os
 import sys
 
+from aqmt.testdata import TestData
 
-def parse_header(line):
+
+def get_rank_bins(cumsum, ranks):
     """
-    The header in queue_packets_ecnXX_s contains the queueing delay in us that
-    this column represents.
+    Find the bin containing the value of the given rank (index in
+    the sorted list of values) for each sample.
 
-    The first column in the header contains number of columns following.
-    We simply ignore this.
+    Each row of cumsum is offset so all samples can be looked up
+    in one call to searchsorted on the flattened matrix.
     """
-    return np.fromstring(line, dtype=int, sep=' ')[1:]
+    n_rows, n_bins = cumsum.shape
+    offsets = np.arange(n_rows) * (cumsum[:, -1].max() + 1)
+    flat = (cumsum + offsets[:, np.newaxis]).ravel()
+    pos = np.searchsorted(flat, ranks + offsets, side='right')
+    return np.minimum(pos - np.arange(n_rows) * n_bins, n_bins - 1)
 
 
-def parse_line(line, header_us):
-    num = np.fromstring(line, dtype=int, sep=' ')[1:]
-    return np.repeat(header_us, num)
+def calc_stats(header_us, counts):
+    """
+    Calculate statistics for all samples directly from the histograms,
+    without expanding them to a list of values for each packet.
 
+    The percentiles match np.percentile(..., interpolation='lower')
+    on the expanded list of values.
 
-def generate_stats(numbers):
-    if numbers.size == 0:
-        res = ['-', '-', '-', '-', '-', '-', '-', '-', '-']
-    else:
-        res = [
-            np.average(numbers).astype('str'),
-            '-',  # not used: np.std(numbers).astype('str'),
-            np.min(numbers).astype('str'),
-            np.percentile(numbers, 1, interpolation='lower').astype('str'),
-            np.percentile(numbers, 25, interpolation='lower').astype('str'),
-            np.percentile(numbers, 50, interpolation='lower').astype('str'),
-            np.percentile(numbers, 75, interpolation='lower').astype('str'),
-            np.percentile(numbers, 99, interpolation='lower').astype('str'),
-            np.max(numbers).astype('str'),
-        ]
+    Returns the number of packets in each sample and a list of columns
+    average, min, p1, p25, p50, p75, p99 and max. The average is nan
+    for samples without packets.
+    """
+    order = np.argsort(header_us, kind='mergesort')
+    values = header_us[order]
+    counts = counts[:, order]
 
-    return ' '.join(res)
+    cumsum = np.cumsum(counts, axis=1)
+    n = cumsum[:, -1] if counts.size > 0 else np.zeros(counts.shape[0], dtype=int)
 
+    def at_rank(ranks):
+        if ranks.size == 0:
+            return np.zeros(0, dtype=values.dtype)
+        return values[get_rank_bins(cumsum, ranks.astype(int))]
 
-def process_test(folder):
-    if not os.path.exists(folder + '/derived'):
-        os.makedirs(folder + '/derived')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average = counts.dot(values) / n
 
-    with open(folder + '/derived/queue_nonecn_samplestats', 'w') as fout:
-        fout.write('#average stddev min p1 p25 p50 p75 p99 max\n')
-        with open(folder + '/ta/queue_packets_ecn00', 'r') as f:
-            header_us = parse_header(f.readline())
-
-            for line in f:
-                fout.write('%s %s\n' % (
-                    line.split()[0],  # time of sample
-                    generate_stats(
-                        parse_line(line, header_us)
-                    )
-                ))
-
-    with open(folder + '/derived/queue_ecn_samplestats', 'w') as fout:
+    columns = [
+        average,
+        at_rank(np.zeros_like(n)),
+    ]
+
+    for q in [1, 25, 50, 75, 99]:
+        columns.append(at_rank(np.floor((n - 1) * (q / 100))))
+
+    columns.append(at_rank(np.maximum(n - 1, 0)))
+
+    return n, columns
+
+
+def generate_stats(n, columns):
+    columns = [col.astype('str') for col in columns]
+    columns.insert(1, None)  # not used: stddev
+
+    res = []
+    for i in range(n.size):
+        if n[i] > 0:
+            res.append(' '.join('-' if col is None else col[i] for col in columns))
+        else:
+            res.append(' '.join(['-'] * len(columns)))
+
+    return res
+
+
+def write_stats(file, times, stats):
+    with open(file, 'w') as fout:
         fout.write('#average stddev min p1 p25 p50 p75 p99 max\n')
+        for time, line in zip(times, stats):
+            fout.write('%d %s\n' % (time, line))
+
+
+def process_test(folder, data=None):
+    if data is None:
+        data = TestData(folder)
+
+    if not os.path.exists(folder + '/derived'):
+        os.makedirs(folder + '/derived')
 
-        f1 = open(folder + '/ta/queue_packets_ecn01', 'r')
-        f2 = open(folder + '/ta/queue_packets_ecn10', 'r')
-        f3 = open(folder + '/ta/queue_packets_ecn11', 'r')
-
-        header_us = parse_header(f1.readline())
-        f2.readline()  # skip the other headers, they should be same
-        f3.readline()
-
-        # all files should have the same amount of lines
-        for line1 in f1:
-            line2 = f2.readline()
-            line3 = f3.readline()
-
-            fout.write('%s %s\n' % (
-                line1.split()[0],  # time of sample
-                generate_stats(
-                    np.concatenate([
-                        parse_line(line1, header_us),
-                        parse_line(line2, header_us),
-                        parse_line(line3, header_us)
-                    ])
-                )
-            ))
-
-        f1.close()
-        f2.close()
-        f3.close()
+    header_us, times, counts = data.get_histograms('queue_packets_ecn00')
+    n, columns = calc_stats(header_us, counts)
+    data.derived['queue_nonecn_average'] = columns[0]
+    write_stats(folder + '/derived/queue_nonecn_samplestats', times, generate_stats(n, columns))
+
+    # all files should have the same header and amount of lines,
+    # so the ECN queue is simply the sum of the histograms
+    counts = sum(data.get_histograms('queue_packets_' + ecn)[2] for ecn in ['ecn01', 'ecn10', 'ecn11'])
+    n, columns = calc_stats(header_us, counts)
+    data.derived['queue_ecn_average'] = columns[0]
+    write_stats(folder + '/derived/queue_ecn_samplestats', times, generate_stats(n, columns))
 
 
 if __name__ == '__main__':
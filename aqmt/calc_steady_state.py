@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# this file detects how many samples at the start of the test are
+# part of the warm-up, before the rate and queueing delay is stable
+#
+# the warm-up is found with the MSER-5 rule (Marginal Standard Error
+# Rule) for each of these series:
+# - the total rate
+# - the average queueing delay of the classic (non-ECT) queue
+# - the average queueing delay of the ECT queue
+#
+# the samples are grouped in batches of 5, and the warm-up is the
+# number of batches removed from the start giving the lowest standard
+# error of the mean of the remaining batches, limited to half of the
+# test. The longest warm-up of the series is used.
+#
+# the result is saved to the details file as:
+# - steady_state_samples
+
+import numpy as np
+import sys
+
+from aqmt.testdata import TestData
+from aqmt.testenv import remove_hint, save_hint_to_folder
+
+BATCH_SIZE = 5
+
+
+def get_warmup(values, batch_size=BATCH_SIZE):
+    """
+    Get the number of samples to remove from the start of a
+    series using the MSER rule
+    """
+    num_batches = values.size // batch_size
+    if num_batches < 2:
+        return 0
+
+    batches = values[:num_batches * batch_size].reshape(num_batches, batch_size).mean(axis=1)
+
+    # sums of the remaining batches when removing d batches
+    sums = np.cumsum(batches[::-1])[::-1]
+    sums_sq = np.cumsum((batches ** 2)[::-1])[::-1]
+    remaining = np.arange(num_batches, 0, -1)
+
+    mser = (sums_sq - sums ** 2 / remaining) / remaining ** 2
+    d = np.argmin(mser[:num_batches // 2 + 1])
+    return int(d * batch_size)
+
+
+def get_queue_average(data, ecn_types):
+    """
+    Get the average queueing delay in us for each sample,
+    or 0 for samples without packets
+    """
+    header_us = data.get_histograms('queue_packets_' + ecn_types[0])[0]
+    counts = sum(data.get_histograms('queue_packets_' + ecn)[2] for ecn in ecn_types)
+
+    n = counts.sum(axis=1)
+    return np.where(n > 0, counts.dot(header_us) / np.maximum(n, 1), 0)
+
+
+def get_series(data):
+    rate_ecn = data.get_table('rate_ecn')
+    rate_nonecn = data.get_table('rate_nonecn')
+
+    return {
+        'rate': (rate_ecn[:, 2] + rate_nonecn[:, 2]).astype(float),
+        'queue_nonecn': get_queue_average(data, ['ecn00']),
+        'queue_ecn': get_queue_average(data, ['ecn01', 'ecn10', 'ecn11']),
+    }
+
+
+def process_test(folder, data=None):
+    """
+    Returns the number of samples detected as warm-up
+    """
+    if data is None:
+        data = TestData(folder)
+
+    warmup = {name: get_warmup(values) for name, values in get_series(data).items()}
+    samples = max(warmup.values())
+
+    remove_hint(folder, ['steady_state_samples'])
+    save_hint_to_folder(folder, 'steady_state_samples %d' % samples)
+
+    return samples
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: %s <test_folder>' % sys.argv[0])
+        sys.exit(1)
+    print(process_test(sys.argv[1]))
@@ -11,9 +11,13 @@
 # - util_tagged
 # - util_tagged_stats
 
+from collections import OrderedDict
 import numpy as np
 import os
 import re
+import sys
+
+from aqmt.testdata import TestData
 
 DEFAULT_TAG = 'Other'
 
@@ -37,6 +41,10 @@ def generate_stats(numbers):
     return ' '.join(res)
 
 
+def write_series(fall, i, values, fmt):
+    fall.write(''.join(fmt % item for item in zip(i.tolist(), values.tolist())))
+
+
 def save_tag_rates(folder, rates, samples_to_skip):
     with open(folder + '/derived/rate_tagged', 'w') as fall:
         fall.write('#sample rate\n')
@@ -46,23 +54,13 @@ def save_tag_rates(folder, rates, samples_to_skip):
 
             first = True
             for tag, values in rates.items():
-                list_rate = []
-                skip = samples_to_skip
-
                 if not first:
                     fall.write('\n\n')
                 first = False
                 fall.write('"%s"\n' % tag)
 
-                for i, rate in enumerate(values):
-                    if skip > 0:
-                        skip -= 1
-                    else:
-                        list_rate.append(rate)
-
-                    fall.write('%d %d\n' % (i, rate))
-
-                fstats.write('"%s" %s\n' % (tag, generate_stats(list_rate)))
+                write_series(fall, np.arange(values.size), values, '%d %d\n')
+                fstats.write('"%s" %s\n' % (tag, generate_stats(values[max(samples_to_skip, 0):])))
 
 
 def save_tag_util(folder, rates, bitrate, samples_to_skip):
@@ -74,60 +72,52 @@ def save_tag_util(folder, rates, bitrate, samples_to_skip):
 
             first = True
             for tag, values in rates.items():
-                list_util = []
-                skip = samples_to_skip
+                utils = values / bitrate
 
                 if not first:
                     fall.write('\n\n')
                 first = False
                 fall.write('"%s"\n' % tag)
 
-                for i, rate in enumerate(values):
-                    util = rate / bitrate
-
-                    if skip > 0:
-                        skip -= 1
-                    else:
-                        list_util.append(util)
-
-                    fall.write('%d %f\n' % (i, util))
+                write_series(fall, np.arange(utils.size), utils, '%d %f\n')
+                fstats.write('"%s" %s\n' % (tag, generate_stats(utils[max(samples_to_skip, 0):])))
 
-                fstats.write('"%s" %s\n' % (tag, generate_stats(list_util)))
 
+def get_rates(data, flows, tags):
+    """
+    Map all known rates to the tag and aggregated rate
 
-def get_rates(folder, flows, tags):
-    """Map all known rates to the tag and aggregated rate"""
+    Returns an ordered dict of tag to an array with the sum of
+    the rates of the flows with this tag for each sample.
+    """
+    all_tags = [DEFAULT_TAG] + [tag for tag in tags if tag != DEFAULT_TAG]
+    tag_index = {tag: i for i, tag in enumerate(all_tags)}
 
-    rates = {DEFAULT_TAG: []}
-    for tag in tags:
-        rates[tag] = []
-
-    n_samples = None  # will use the last one in following loop
+    sums = None
+    tags_seen = set()
     for ecntype in ['ecn', 'nonecn']:
-        n_samples = 0
-        with open(folder + '/ta/flows_rate_' + ecntype) as f:
-            # 0 1000 6152397 3693860
-            for line in f:
-                n_samples += 1
+        # 0 1000 6152397 3693860
+        table = data.get_table('flows_rate_' + ecntype)
+        matrix = table[:, 2:] if table.size > 0 else np.zeros((0, 0), dtype=int)
+        flow_tags = [flow['tag'] for flow in flows[ecntype]][:matrix.shape[1]]
+        tags_seen.update(flow_tags)
 
-                for i, rate in enumerate(line.split()[2:]):
-                    tag = flows[ecntype][i]['tag']
+        # matrix mapping each flow (column) to its tag
+        onehot = np.zeros((len(flow_tags), len(all_tags)), dtype=int)
+        onehot[np.arange(len(flow_tags)), [tag_index[tag] for tag in flow_tags]] = 1
 
-                    if len(rates[tag]) < n_samples:
-                        rates[tag].append(0)
+        # all files should have the same amount of lines
+        tag_sums = matrix.dot(onehot)
+        sums = tag_sums if sums is None or sums.shape[0] == 0 else sums + tag_sums
 
-                    rates[tag][n_samples - 1] += int(rate)
+    rates = OrderedDict()
+    for tag in all_tags:
+        rates[tag] = sums[:, tag_index[tag]]
 
     # remove unknown if all is tagged
-    if len(rates[DEFAULT_TAG]) == 0:
+    if DEFAULT_TAG not in tags_seen or sums.shape[0] == 0:
         rates.pop(DEFAULT_TAG)
 
-    # make sure all lists are filled up
-    # (in case no traffic is detected on a tag)
-    for tag in tags:
-        if len(rates[tag]) == 0:
-            rates[tag] = [0] * n_samples
-
     return rates
 
 
@@ -145,71 +135,81 @@ def extract_properties(line):
     return list
 
 
-def get_classification(folder):
+def get_classification(data):
     tags = set()
     classify = []
 
-    with open(folder + '/details', 'r') as f:
-        for line in f:
-            if line.startswith('traffic='):
-                properties = extract_properties(line)
-                if 'tag' in properties:
-                    tag = properties['tag']
-                    tags.add(tag)
+    metadata_kv, metadata_lines = data.get_details()
+    for key, value in metadata_lines:
+        if key.startswith('traffic='):
+            properties = extract_properties(key + ' ' + value)
+            if 'tag' in properties:
+                tag = properties['tag']
+                tags.add(tag)
 
-                    classify_by = 'client' if 'client' in properties else 'server'
-                    classify.append({classify_by: properties[classify_by], 'tag': tag})
+                classify_by = 'client' if 'client' in properties else 'server'
+                classify.append({classify_by: properties[classify_by], 'tag': tag})
 
     return [list(tags), classify]
 
 
-def get_bitrate(folder):
-    with open(folder + '/details', 'r') as f:
-        for line in f:
-            if line.startswith('testbed_rate '):
-                return int(line.split(' ')[1])
+def get_bitrate(data):
+    metadata_kv, metadata_lines = data.get_details()
+    if 'testbed_rate' in metadata_kv:
+        return int(metadata_kv['testbed_rate'])
 
     raise Exception('Could not determine bitrate used in test')
 
 
-def get_flows(folder, classify):
+def get_flows(data, classify):
+    # index the classification by port, keeping the first match
+    # in the list in case a port is classified multiple times
+    client_ports = {}
+    server_ports = {}
+    for i, item in enumerate(classify):
+        if 'client' in item:
+            client_ports.setdefault(item['client'], (i, item['tag']))
+        elif 'server' in item:
+            server_ports.setdefault(item['server'], (i, item['tag']))
+
     flows = {'ecn': [], 'nonecn': []}
     for ecntype in ['ecn', 'nonecn']:
-        with open(folder + '/ta/flows_' + ecntype) as f:
-            for line in f:
-                # TCP 10.25.2.21 5504 10.25.1.11 53898
-                _type, srcip, srcport, dstip, dstport = line.split()
-
-                # identify the tag
-                tag = DEFAULT_TAG
-                for item in classify:
-                    if 'client' in item and item['client'] == dstport:
-                        tag = item['tag']
-                        break
-                    elif 'server' in item and item['server'] == srcport:
-                        tag = item['tag']
-                        break
-
-                flows[ecntype].append({
-                    'flow': line.strip(),
-                    'tag': tag
-                })
+        for line in data.get_flows(ecntype):
+            # TCP 10.25.2.21 5504 10.25.1.11 53898
+            _type, srcip, srcport, dstip, dstport = line.split()
+
+            # identify the tag
+            matches = []
+            if dstport in client_ports:
+                matches.append(client_ports[dstport])
+            if srcport in server_ports:
+                matches.append(server_ports[srcport])
+
+            tag = min(matches)[1] if len(matches) > 0 else DEFAULT_TAG
+
+            flows[ecntype].append({
+                'flow': line,
+                'tag': tag
+            })
 
     return flows
 
 
-def process_test(folder, samples_to_skip):
+def process_test(folder, samples_to_skip, data=None):
+    if data is None:
+        data = TestData(folder)
+
     if not os.path.exists(folder + '/derived'):
         os.makedirs(folder + '/derived')
 
     if not os.path.exists(folder + '/aggregated'):
         os.makedirs(folder + '/aggregated')
 
-    tags, classify = get_classification(folder)
-    bitrate = get_bitrate(folder)
-    flows = get_flows(folder, classify)
+    tags, classify = get_classification(data)
+    bitrate = get_bitrate(data)
+    flows = get_flows(data, classify)
 
-    rates = get_rates(folder, flows, tags)
+    rates = get_rates(data, flows, tags)
 
     save_tag_rates(folder, rates, samples_to_skip)
     save_tag_util(folder, rates, bitrate, samples_to_skip)
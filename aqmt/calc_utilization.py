@@ -7,43 +7,35 @@
 import os
 import sys
 
+from aqmt.testdata import TestData
 
-def parse_line(line):
-    return int(line.split()[2])
 
+def process_test(folder, link_bitrate, data=None):
+    if data is None:
+        data = TestData(folder)
 
-def process_test(folder, link_bitrate):
     if not os.path.exists(folder + '/derived'):
         os.makedirs(folder + '/derived')
 
+    # format of rate file:
+    # <sample id> <sample time> <rate in b/s>
+    rates_ecn = data.get_table('rate_ecn')
+    rates_nonecn = data.get_table('rate_nonecn')
+
     with open(folder + '/derived/util', 'w') as fout:
         fout.write('# sample_id total_util_in_percent ecn_util_in_percent nonecn_util_in_percent\n')
 
-        f1 = open(folder + '/ta/rate_ecn', 'r')
-        f2 = open(folder + '/ta/rate_nonecn', 'r')
-
         # all files should have the same amount of lines
-        for line1 in f1:
-            line2 = f2.readline()
-
-            # skip comments
-            if line1[0] == '#':
-                continue
-
-            rate_ecn = parse_line(line1)
-            rate_nonecn = parse_line(line2)
+        for sample_id, rate_ecn, rate_nonecn in zip(rates_ecn[:, 0], rates_ecn[:, 2], rates_nonecn[:, 2]):
             rate_tot = rate_ecn + rate_nonecn
 
-            fout.write('%s %f %f %f\n' % (
-                line1.split()[0],
+            fout.write('%d %f %f %f\n' % (
+                sample_id,
                 rate_tot / link_bitrate,
                 rate_ecn / link_bitrate,
                 rate_nonecn / link_bitrate
             ))
 
-        f1.close()
-        f2.close()
-
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
@@ -12,31 +12,31 @@
 # Dependency:
 # - calc_queuedelay.py (for per sample queue stats)
 
+import numpy as np
 import os
 import sys
 
+from aqmt.testdata import TestData
 
-def get_rates(rate_file):
-    rates = []
 
-    with open(rate_file, 'r') as f:
-        for line in f:
-            # skip comments
-            if line[0] == '#':
-                continue
-
-            # format of rate file:
-            # <sample id> <sample time> <rate in b/s>
-
-            rates.append(int(line.split()[2]))
-
-    return rates
+def get_rates(data, ecntype):
+    # format of rate file:
+    # <sample id> <sample time> <rate in b/s>
+    return data.get_table('rate_' + ecntype)[:, 2]
 
 
-def get_rtts_with_queue(queue_file, base_rtt):
-    rtts = []
+def get_queue_averages(data, ecntype):
+    """
+    Get the average queueing delay in us of each sample, or nan if
+    it is unknown. Uses the values kept in memory by calc_queuedelay
+    if available, otherwise it reads them from its output.
+    """
+    name = 'queue_%s_average' % ecntype
+    if name in data.derived:
+        return data.derived[name]
 
-    with open(queue_file, 'r') as f:
+    averages = []
+    with open(data.folder + '/derived/queue_%s_samplestats' % ecntype, 'r') as f:
         for line in f:
             # skip comments
             if line[0] == '#':
@@ -46,25 +46,23 @@ def get_rtts_with_queue(queue_file, base_rtt):
             # <sample time> <average_in_us> ...
             # the average might be '-' if it is unknown
             queue_avg = line.split()[1]
-            queue_avg = 0 if queue_avg == '-' else float(queue_avg)
+            averages.append(float('nan') if queue_avg == '-' else float(queue_avg))
 
-            # add rtt and normalize to seconds
-            # base rtt is in ms
-            rtts.append((queue_avg / 1000 + base_rtt) / 1000)
+    return np.array(averages)
 
-    return rtts
 
+def get_rtts_with_queue(queue_averages, base_rtt):
+    queue_averages = np.where(np.isnan(queue_averages), 0, queue_averages)
 
-def calc_window(rates, rtts_s):
-    windows = []
-
-    # all data should have same amount of samples
-    for i, rate in enumerate(rates):
-        rtt = rtts_s[i]  # rtt in seconds
+    # add rtt and normalize to seconds
+    # base rtt is in ms
+    return (queue_averages / 1000 + base_rtt) / 1000
 
-        windows.append(rate * rtt)
 
-    return windows
+def calc_window(rates, rtts_s):
+    # all data should have same amount of samples
+    # rtt in seconds
+    return rates * rtts_s
 
 
 def write_window(file, window_ecn_list, window_nonecn_list):
@@ -77,16 +75,19 @@ def write_window(file, window_ecn_list, window_nonecn_list):
             f.write('%d %d %d\n' % (i, window_ecn, window_nonecn))
 
 
-def process_test(folder, base_rtt_ecn_ms, base_rtt_nonecn_ms):
+def process_test(folder, base_rtt_ecn_ms, base_rtt_nonecn_ms, data=None):
+    if data is None:
+        data = TestData(folder)
+
     write_window(
         folder + '/derived/window',
         calc_window(
-            get_rates(folder + '/ta/rate_ecn'),
-            get_rtts_with_queue(folder + '/derived/queue_ecn_samplestats', base_rtt_ecn_ms),
+            get_rates(data, 'ecn'),
+            get_rtts_with_queue(get_queue_averages(data, 'ecn'), base_rtt_ecn_ms),
         ),
         calc_window(
-            get_rates(folder + '/ta/rate_nonecn'),
-            get_rtts_with_queue(folder + '/derived/queue_nonecn_samplestats', base_rtt_nonecn_ms),
+            get_rates(data, 'nonecn'),
+            get_rtts_with_queue(get_queue_averages(data, 'nonecn'), base_rtt_nonecn_ms),
         ),
     )
 
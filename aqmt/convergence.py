@@ -0,0 +1,170 @@
+"""
+This module contains the logic for stopping a test early when
+its results have converged
+
+While the analyzer runs, the rate and queue files it writes are
+read as they grow. The samples after the warm-up are split into
+a number of batches, and the confidence interval of each metric
+is estimated from the mean of the batches (the batch means method).
+The test has converged when the half-width of the confidence
+interval of all metrics is within the tolerance:
+- the utilization (total rate)
+- the p50 and p99 queueing delay of each queue with traffic
+
+As the half-width of a percentile of an empty queue is zero, the
+queueing delay uses an absolute tolerance as a lower limit.
+"""
+
+import numpy as np
+import os
+
+from . import calc_queuedelay
+from . import logger
+
+NUM_BATCHES = 20
+
+# t-distribution value for 95 % confidence with NUM_BATCHES - 1 degrees of freedom
+T_VALUE = 2.093
+
+QUEUE_DELAY_TOLERANCE_US = 1000
+
+
+class FileTail:
+    """
+    Reads the complete lines added to a file since the last read
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.offset = 0
+
+    def read_lines(self):
+        if not os.path.isfile(self.file):
+            return []
+
+        with open(self.file, 'r') as f:
+            f.seek(self.offset)
+            text = f.read()
+
+        # the last line might not be completely written yet
+        end = text.rfind('\n') + 1
+        self.offset += len(text[:end].encode())
+        return text[:end].splitlines()
+
+
+def get_percentiles(header_us, counts):
+    """
+    Get the p50 and p99 of each row of histograms, calculated as
+    by calc_queuedelay.py, or 0 for rows without packets
+
+    Returns a dict of percentile to array with a value for each row.
+    """
+    n, columns = calc_queuedelay.calc_stats(header_us, counts)
+
+    # the columns are average, min, p1, p25, p50, p75, p99 and max
+    return {p: np.where(n > 0, columns[i], 0) for p, i in [(50, 4), (99, 6)]}
+
+
+def get_half_width(values):
+    """
+    Half-width of the confidence interval of the mean of batches
+    """
+    return T_VALUE * np.std(values, ddof=1) / np.sqrt(values.size)
+
+
+class ConvergenceMonitor:
+    def __init__(self, ta_folders, samples_to_skip, tolerance):
+        """
+        ta_folders: Folders the analyzers write to, the samples
+          of multiple analyzers are summed (see merge_ta.py)
+        samples_to_skip: Samples of warm-up not used
+        tolerance: Maximum half-width of the confidence intervals
+          relative to the mean, e.g. 0.05
+        """
+        self.samples_to_skip = samples_to_skip
+        self.tolerance = tolerance
+
+        self.rate_files = [[FileTail(folder + '/' + name) for folder in ta_folders] for name in ['rate_ecn', 'rate_nonecn']]
+        self.rates = [[[] for folder in ta_folders] for name in ['rate_ecn', 'rate_nonecn']]
+
+        self.queues = {
+            'nonecn': ['ecn00'],
+            'ecn': ['ecn01', 'ecn10', 'ecn11'],
+        }
+        self.queue_files = {ecn: [FileTail(folder + '/queue_packets_' + ecn) for folder in ta_folders] for ecn in ['ecn00', 'ecn01', 'ecn10', 'ecn11']}
+        self.queue_rows = {ecn: [[] for folder in ta_folders] for ecn in self.queue_files}
+        self.header_us = None
+        self.headers_read = set()
+
+    def read(self):
+        """
+        Read the samples written since the last call
+        """
+        for tails, rates in zip(self.rate_files, self.rates):
+            for tail, values in zip(tails, rates):
+                # <sample id> <time> <rate>
+                values.extend(int(line.split()[2]) for line in tail.read_lines())
+
+        for ecn, tails in self.queue_files.items():
+            for tail, rows in zip(tails, self.queue_rows[ecn]):
+                lines = tail.read_lines()
+                if tail.file not in self.headers_read and len(lines) > 0:
+                    # the header contains the queueing delay of each column, all
+                    # files have the same header (the first column is the
+                    # number of columns following)
+                    self.header_us = np.array(lines.pop(0).split()[1:], dtype=int)
+                    self.headers_read.add(tail.file)
+
+                # <time> <count for each column>
+                rows.extend(np.array(line.split()[1:], dtype=int) for line in lines)
+
+    def get_num_samples(self):
+        return min(len(values) for lists in self.rates + list(self.queue_rows.values()) for values in lists)
+
+    def get_metrics(self):
+        """
+        Get a list of (name, batch values, absolute tolerance) for
+        each metric, using the samples after the warm-up
+        """
+        n = self.get_num_samples() - self.samples_to_skip
+        batch_size = n // NUM_BATCHES
+        if batch_size < 1:
+            return None
+
+        def batches(values):
+            values = values[self.samples_to_skip:self.samples_to_skip + batch_size * NUM_BATCHES]
+            return values.reshape((NUM_BATCHES, batch_size) + values.shape[1:])
+
+        def total(lists):
+            # sum the samples of all analyzers
+            return sum(np.array(values[:n + self.samples_to_skip]) for values in lists)
+
+        rate = batches(total(self.rates[0]) + total(self.rates[1]))
+        metrics = [('utilization', rate.mean(axis=1), 0)]
+
+        for queue, ecn_types in self.queues.items():
+            counts = batches(sum(total(self.queue_rows[ecn]) for ecn in ecn_types)).sum(axis=1)
+            if counts.sum() == 0:
+                continue  # no traffic in this queue
+
+            for p, values in get_percentiles(self.header_us, counts).items():
+                metrics.append(('queue_%s_p%d' % (queue, p), values.astype(float), QUEUE_DELAY_TOLERANCE_US))
+
+        return metrics
+
+    def is_converged(self):
+        self.read()
+
+        metrics = self.get_metrics()
+        if metrics is None:
+            return False
+
+        for name, values, abs_tolerance in metrics:
+            mean = values.mean()
+            half_width = get_half_width(values)
+            if half_width > max(self.tolerance * abs(mean), abs_tolerance):
+                logger.debug('Not converged after %d samples: %s is %f +- %f' % (
+                    self.get_num_samples(), name, mean, half_width))
+                return False
+
+        return True
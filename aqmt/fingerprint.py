@@ -0,0 +1,110 @@
+"""
+This module contains the logic for skipping analysis stages
+whose inputs have not changed since they were last run
+
+Each stage records a fingerprint in the details file of the test.
+The fingerprint covers the size and modification time of the input
+files, the parameters given to the stage, the code of the stage and
+the fingerprints of the stages it depends on. A stage is therefore
+rerun when any of the stages it depends on changes.
+"""
+
+import hashlib
+import os
+
+from . import logger
+from . import timeline
+from .testenv import read_metadata, remove_hint, save_hint_to_folder
+
+code_versions = {}
+
+
+def get_code_version(file):
+    """
+    Get a hash of a file containing code, e.g. a Python
+    module or a compiled program
+    """
+    if file not in code_versions:
+        h = hashlib.sha1()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+        code_versions[file] = h.hexdigest()
+
+    return code_versions[file]
+
+
+def get_file_fingerprint(file):
+    try:
+        st = os.stat(file)
+    except FileNotFoundError:
+        return '%s missing' % os.path.basename(file)
+
+    return '%s %d %d' % (os.path.basename(file), st.st_size, st.st_mtime_ns)
+
+
+class AnalysisStages:
+    """
+    Runs the analysis stages of a single test, skipping the ones
+    that are up to date
+    """
+
+    def __init__(self, testfolder, force=False):
+        self.testfolder = testfolder
+        self.force = force
+        self.fingerprints = {}  # fingerprints of stages seen in this run
+        self.saved = {}  # fingerprints stored in the details file
+
+        metadata_kv, metadata_lines = read_metadata(testfolder + '/details')
+        for key, value in metadata_lines:
+            if key == 'analyzed_stage':
+                name, fingerprint = value.split()
+                self.saved[name] = fingerprint
+
+    def get_fingerprint(self, name, code, inputs, params, depends):
+        h = hashlib.sha1()
+        parts = [name] + \
+            [get_code_version(file) for file in code] + \
+            [get_file_fingerprint(file) for file in inputs] + \
+            [repr(param) for param in params] + \
+            [self.fingerprints[dependency] for dependency in depends]
+
+        for part in parts:
+            h.update(part.encode())
+            h.update(b'\n')
+
+        return h.hexdigest()
+
+    def run(self, name, fn, code=(), inputs=(), params=(), depends=(), outputs=()):
+        """
+        Run a stage unless it is up to date
+
+        name: Unique name of the stage
+        fn: Function without arguments that runs the stage
+        code: Files containing the code of the stage
+        inputs: Files the stage reads, except files written by other stages
+        params: Other values the result of the stage depends on
+        depends: Names of previous stages whose output is used
+        outputs: Files the stage writes, the stage is rerun if any is missing
+
+        Returns True if the stage was run
+        """
+        fingerprint = self.get_fingerprint(name, code, inputs, params, depends)
+        self.fingerprints[name] = fingerprint
+
+        if not self.force and self.saved.get(name) == fingerprint and \
+                all(os.path.isfile(file) for file in outputs):
+            logger.debug('Analysis stage %s is up to date' % name)
+            return False
+
+        with timeline.span(self.testfolder, name, 'analyze', test=self.testfolder):
+            fn()
+
+        self.saved[name] = fingerprint
+        self.save()
+        return True
+
+    def save(self):
+        remove_hint(self.testfolder, ['analyzed_stage'])
+        for name, fingerprint in self.saved.items():
+            save_hint_to_folder(self.testfolder, 'analyzed_stage %s %s' % (name, fingerprint))
@@ -0,0 +1,132 @@
+"""
+This module contains the campaign journal, recording the state of
+each test so a campaign that stops (e.g. by a reboot or a lost SSH
+connection) can be resumed where it stopped
+
+The journal is the file journal.jsonl in the root folder of the
+campaign. It is only appended to, one line of JSON for each change,
+and is written to disk before continuing. A line is either the start
+of a campaign with the hash of its test plan, or the new state of a
+test:
+- queued: The test is planned to run
+- running: The data collection has started
+- failed: Running the test failed, with the reason
+- collected: The data collection finished
+- analyzed: The analysis finished
+- plotted: The plotting finished
+
+When a test has been analyzed and plotted, a runtime line stores the
+hints of its details file used to estimate the time of later tests
+(see runtime.py), so the history can be read without the details files.
+
+When resuming, the last state of a test decides what is done with
+it, instead of reading the details file of every test. Tests not
+in the journal, e.g. from before it was used, are found by the
+details file as before.
+"""
+
+import json
+import os
+import threading
+import time
+
+from . import logger
+
+JOURNAL_FILE = 'journal.jsonl'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FAILED = 'failed'
+COLLECTED = 'collected'
+ANALYZED = 'analyzed'
+PLOTTED = 'plotted'
+
+# states where the test has data that can be used
+DATA_STATES = [COLLECTED, ANALYZED, PLOTTED]
+
+
+class Journal:
+    def __init__(self, folder):
+        self.folder = folder
+        self.file = folder + '/' + JOURNAL_FILE
+        self.plan_hash = None
+        self.tests = {}  # test folder relative to the campaign -> last record
+        self.runtime = {}  # test folder relative to the campaign -> hints for runtime history
+        self.needs_newline = False
+        self.lock = threading.Lock()
+
+        if os.path.isfile(self.file):
+            self.load()
+
+    def load(self):
+        with open(self.file, 'r') as f:
+            for line in f:
+                try:
+                    self.apply(json.loads(line))
+                except ValueError:
+                    pass  # partly written line, e.g. from a crash
+
+                # make sure the next record is on its own line
+                self.needs_newline = not line.endswith('\n')
+
+    def apply(self, record):
+        if 'plan_hash' in record:
+            self.plan_hash = record['plan_hash']
+        if 'state' in record:
+            self.tests[record['test']] = record
+        if record.get('event') == 'runtime':
+            self.runtime[record['test']] = record['hints']
+
+    def write(self, records):
+        """
+        Append records to the journal and make sure they are on disk
+        """
+        now = time.time()
+        with self.lock:
+            with open(self.file, 'a') as f:
+                if self.needs_newline:
+                    f.write('\n')
+                    self.needs_newline = False
+                for record in records:
+                    record['time'] = now
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            for record in records:
+                self.apply(record)
+
+    def get_key(self, test_folder):
+        return os.path.relpath(test_folder, self.folder)
+
+    def get_state(self, test_folder):
+        """
+        Get the last state of a test, or None if not in the journal
+        """
+        record = self.tests.get(self.get_key(test_folder))
+        return record['state'] if record is not None else None
+
+    def record(self, test_folder, state, **args):
+        self.write([dict(args, test=self.get_key(test_folder), state=state)])
+
+    def record_runtime(self, test_folder, hints):
+        """
+        Record the hints of a test used by the runtime history
+        """
+        self.write([{'event': 'runtime', 'test': self.get_key(test_folder), 'hints': hints}])
+
+    def start_campaign(self, plan_hash, tests):
+        """
+        Record the start of running a campaign
+
+        tests: List of PlannedTest found in the dry run
+        """
+        if self.plan_hash is not None and self.plan_hash != plan_hash:
+            logger.info('The test plan has changed since the previous run, tests with data are kept')
+
+        records = [{'event': 'campaign', 'plan_hash': plan_hash, 'tests': len(tests)}]
+        for test in tests:
+            if test.will_test:
+                records.append({'test': self.get_key(test.collection.folder + '/test'), 'state': QUEUED})
+
+        self.write(records)
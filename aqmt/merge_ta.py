@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# this file merges the output of multiple analyzers each capturing
+# a part of the flows of a test (see ta_shards in testbed.py) into
+# the ta folder, so the result is the same as if one analyzer was used
+#
+# each analyzer writes to ta/shard-<n>. The samples are matched by
+# their number, and the time of a sample is taken from the first
+# analyzer. If the analyzers have a different number of samples,
+# only the samples all of them have are used.
+# - the rates, drops, marks and number of packets are summed
+# - the histograms of the queueing delay and drops are summed
+# - the flows of all analyzers are listed after each other, and
+#   the values of each flow are kept in the same order
+
+import numpy as np
+import os
+import sys
+
+SHARD_PREFIX = 'shard-'
+
+# <sample id> <time> <value>
+SAMPLE_FILES = ['rate', 'rate_ecn', 'rate_nonecn', 'drops_ecn', 'drops_nonecn', 'marks_ecn', 'marks_nonecn']
+
+# <value>
+PACKETS_FILES = ['packets_ecn', 'packets_nonecn']
+
+# <number of columns> <queueing delay of each column>
+# <time> <count for each column>
+HISTOGRAM_FILES = ['queue_%s_%s' % (type, ecn) for type in ['packets', 'drops'] for ecn in ['ecn00', 'ecn01', 'ecn10', 'ecn11']]
+
+# <sample id> <time> <value for each flow>
+FLOW_FILES = {
+    'ecn': ['flows_rate_ecn', 'flows_drops_ecn', 'flows_marks_ecn'],
+    'nonecn': ['flows_rate_nonecn', 'flows_drops_nonecn', 'flows_marks_nonecn'],
+}
+
+
+def get_shard_folder(test_folder, shard):
+    return test_folder + '/ta/' + SHARD_PREFIX + str(shard)
+
+
+def get_shard_folders(test_folder):
+    ta_folder = test_folder + '/ta'
+    shards = [int(name[len(SHARD_PREFIX):]) for name in os.listdir(ta_folder) if name.startswith(SHARD_PREFIX)]
+    return [get_shard_folder(test_folder, shard) for shard in sorted(shards)]
+
+
+def read_rows(file):
+    with open(file, 'r') as f:
+        return [line.split() for line in f if line.strip() != '']
+
+
+def write_rows(file, rows):
+    with open(file, 'w') as f:
+        for row in rows:
+            f.write(' '.join(str(value) for value in row) + '\n')
+
+
+def sum_rows(tables, num_samples, num_fixed):
+    """
+    Sum the values of each row of the tables, keeping the first
+    num_fixed columns (e.g. sample id and time) of the first table
+    """
+    rows = []
+    for i in range(num_samples):
+        values = sum(np.array(table[i][num_fixed:], dtype=np.int64) for table in tables)
+        rows.append(tables[0][i][:num_fixed] + list(values))
+    return rows
+
+
+def process_test(test_folder):
+    shards = get_shard_folders(test_folder)
+    if len(shards) == 0:
+        raise Exception('No analyzer output to merge in %s' % test_folder)
+
+    out = test_folder + '/ta/'
+    num_samples = min(len(read_rows(shard + '/rate')) for shard in shards)
+
+    for name in SAMPLE_FILES:
+        tables = [read_rows(shard + '/' + name) for shard in shards]
+        write_rows(out + name, sum_rows(tables, num_samples, 2))
+
+    for name in PACKETS_FILES:
+        tables = [read_rows(shard + '/' + name) for shard in shards]
+        write_rows(out + name, sum_rows(tables, num_samples, 0))
+
+    for name in HISTOGRAM_FILES:
+        tables = [read_rows(shard + '/' + name) for shard in shards]
+        header = tables[0][0]
+        write_rows(out + name, [header] + sum_rows([table[1:] for table in tables], num_samples, 1))
+
+    for ecn, names in FLOW_FILES.items():
+        flows = []
+        for shard in shards:
+            flows.extend(read_rows(shard + '/flows_' + ecn))
+        write_rows(out + 'flows_' + ecn, flows)
+
+        for name in names:
+            tables = [read_rows(shard + '/' + name) for shard in shards]
+            write_rows(out + name, [
+                tables[0][i][:2] + [value for table in tables for value in table[i][2:]]
+                for i in range(num_samples)
+            ])
+
+    return num_samples
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: %s <test_folder>' % sys.argv[0])
+        sys.exit(1)
+    print('Merged %d samples' % process_test(sys.argv[1]))
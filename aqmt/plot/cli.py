@@ -2,15 +2,17 @@
 
 """
 This module provides a CLI that can be used to plot collections
-manually.
+manually, as well as reanalyzing existing tests.
 """
 
 import argparse
 import os.path
+import sys
 
 from aqmt.plot.common import PlotAxis
 from aqmt.plot import collection_components
 from aqmt.plot import plot_folder_compare, plot_folder_flows, plot_tests
+from aqmt.reanalyze import analyze_folder
 
 
 def command_comparison(args):
@@ -49,6 +51,20 @@ def command_plot_tests(args):
     plot_tests(args.folder)
 
 
+def command_analyze(args):
+    results = analyze_folder(
+        args.folder,
+        workers=args.jobs,
+        samples_to_skip=args.samples_to_skip,
+        plot=not args.noplot,
+        force=args.force,
+        detect_steady_state=args.steady_state,
+    )
+
+    if any(result['error'] is not None for result in results):
+        sys.exit(1)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(help='sub-command help')
@@ -72,6 +88,15 @@ if __name__ == '__main__':
     parser_c.add_argument('folder', help='directory containg collections to inclued')
     parser_c.set_defaults(func=command_plot_tests)
 
+    parser_d = subparsers.add_parser('analyze', help='analyze and plot all tests in parallel')
+    parser_d.add_argument('folder', help='directory containing collections to include')
+    parser_d.add_argument('-j', '--jobs', help='number of processes (default or 0: number of CPUs)', type=int)
+    parser_d.add_argument('--samples-to-skip', help='override samples to skip for aggregated data', type=int)
+    parser_d.add_argument('--noplot', help='only analyze, do not plot the tests', action='store_true')
+    parser_d.add_argument('--force', help='rerun all analysis stages, also those up to date', action='store_true')
+    parser_d.add_argument('--steady-state', help='skip the samples detected as warm-up for aggregated data', action='store_true')
+    parser_d.set_defaults(func=command_analyze)
+
     args = parser.parse_args()
     if hasattr(args, 'func'):
         args.func(args)
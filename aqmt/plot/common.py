@@ -3,6 +3,7 @@ from plumbum import local
 import re
 
 from . import treeutil
+from .. import timeline
 from ..testenv import read_metadata
 
 
@@ -132,7 +133,8 @@ def export(output_file, gpi_def):
     with open(output_file + '.gpi', 'w') as f:
         f.write(gpi)
 
-    local['gnuplot'][output_file + '.gpi'].run(stdin=None, stdout=None, stderr=None, retcode=None)
+    with timeline.span(os.path.dirname(output_file), 'export', 'plot', file=output_file + '.pdf'):
+        local['gnuplot'][output_file + '.gpi'].run(stdin=None, stdout=None, stderr=None, retcode=None)
 
 
 class PlotAxis:
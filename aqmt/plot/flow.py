@@ -1,4 +1,5 @@
 from .common import plot_header
+from ..testdata import TestData
 
 
 def get_aggregated_samples_to_skip(testfolder):
@@ -17,12 +18,7 @@ def get_number_samples(testfolder):
     We avoid looking at ta_samples in details-file because
     the test might have been interrupted.
     """
-    n = 0
-    with open(testfolder + '/ta/rate', 'r') as f:
-        for _ in f:
-            n += 1
-
-    return n
+    return TestData(testfolder).get_table('rate').shape[0]
 
 
 def build_plot(testfolder, components, x_scale=1, y_scale=1, title='DEFAULT',
@@ -1,5 +1,6 @@
 from collections import OrderedDict
 from .common import add_plot, add_scale
+from ..testdata import TestData
 
 
 def utilization_queues(y_logarithmic=False, total=True, ecn=True, flows=True):
@@ -59,15 +60,11 @@ def utilization_queues(y_logarithmic=False, total=True, ecn=True, flows=True):
 def rate_per_flow(y_logarithmic=False):
     def plot(testfolder, plotdef):
         label_y_pos = -0.06 * (1/plotdef.y_scale)
-        flows = OrderedDict({
-            'ecn': [],
-            'nonecn': []
-        })
-
-        for ecntype, items in flows.items():
-            with open(testfolder + '/ta/flows_' + ecntype, 'r') as f:
-                for line in f:
-                    items.append(line.strip())
+        data = TestData(testfolder)
+        flows = OrderedDict([
+            ('ecn', data.get_flows('ecn')),
+            ('nonecn', data.get_flows('nonecn')),
+        ])
 
         gpi = """
             set format y "%.0f"
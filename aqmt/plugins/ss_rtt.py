@@ -33,7 +33,7 @@ def pre_hook(testcase):
             # for it so that we can actually SIGTERM the bash process
             # causing the ssh connection to terminate and bash script
             # to end.
-            ssh -tt """ + os.environ['IP_SERVER%s_MGMT' % node] + """ '
+            ssh $AQMT_SSH_OPTIONS -tt """ + os.environ['IP_SERVER%s_MGMT' % node] + """ '
                 getdata() {
                     ss -ni "( src %s or dst %s or src %s or dst %s )" | \\
                         grep -B1 " rtt:" | \\
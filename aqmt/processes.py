@@ -2,56 +2,181 @@
 This module handles process related stuff such as keeping track
 of special processes we want to kill later and utility methods
 for handling running processes.
+
+The processes we start run in their own process group (the panes
+in tmux also do), so that stopping a process also stops anything
+it has started, e.g. the ssh process of a traffic generator.
+
+Waiting for a process uses a pidfd where supported, so we are
+woken up as soon as it exits instead of polling for it.
 """
 
-import errno
-import time
 import os
+import select
 import signal
+import time
 
 from . import logger
 
+# seconds to wait for processes to stop before they are killed
+KILL_TIMEOUT = 2
+
 is_exiting = False
 known_pids = []
+group_leaders = set()  # known pids that have their own process group
+
 
+def kill_known_pids(timeout=KILL_TIMEOUT):
+    """
+    Stop all known processes
 
-def kill_known_pids():
+    All processes are signalled at once and given time to stop
+    before the remaining ones are killed.
+    """
     global known_pids
-    for pid in known_pids:
+    pids = known_pids
+    known_pids = []
+
+    for pid in pids:
         kill_pid(pid)
 
-    known_pids = []
+    remaining = wait_pids(pids, timeout=timeout, include_group=True)
+    for pid in remaining:
+        logger.warn('PID %d did not stop, killing it' % pid)
+        signal_pid(pid, signal.SIGKILL)
+
+    wait_pids(remaining, timeout=timeout, include_group=True)
+    group_leaders.difference_update(pids)
 
 
 def add_known_pid(pid):
     global known_pids
     known_pids.append(pid)
 
-
-def kill_pid(pid):
     try:
-        os.kill(pid, signal.SIGTERM)
-        logger.trace('Sent SIGTERM to PID %d' % pid)
+        if os.getpgid(pid) == pid:
+            group_leaders.add(pid)
     except ProcessLookupError:
         pass
 
 
-def is_running(pid):
+def signal_pid(pid, sig):
+    """
+    Send a signal to the process, or its process group if it has one
+
+    A group where only processes of another user are left (e.g. the
+    analyzer run with sudo) cannot be signalled, which is logged.
+    """
     try:
-        os.kill(pid, 0)
-    except OSError as err:
-        if err.errno == errno.ESRCH:
-            return False
-    return True
+        if pid in group_leaders or os.getpgid(pid) == pid:
+            os.killpg(pid, sig)
+        else:
+            os.kill(pid, sig)
+    except ProcessLookupError:
+        pass
+    except PermissionError:
+        logger.warn('Not permitted to send signal %d to PID %d' % (sig, pid))
 
 
-def waitpid(pid):
-    # due to some issues when running child process vs tmux this is a bit more complex
-    # first use os.waitpid in case this is a child of current process
+def kill_pid(pid):
+    signal_pid(pid, signal.SIGTERM)
+    logger.trace('Sent SIGTERM to PID %d' % pid)
+
+
+def reap(pid):
+    """
+    Collect the exit status if this is an exited child of
+    the current process, so it is not seen as running
+    """
     try:
-        os.waitpid(pid, 0)
+        os.waitpid(pid, os.WNOHANG)
     except ChildProcessError:
         pass
 
-    while is_running(pid):
-        time.sleep(0.3)
+
+def is_running(pid, include_group=False):
+    """
+    include_group: Also count other processes left in its process group
+    """
+    reap(pid)
+    try:
+        if include_group and pid in group_leaders:
+            os.killpg(pid, 0)
+        else:
+            os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def open_pidfd(pid):
+    """
+    Returns a file descriptor that becomes readable when the
+    process exits, or None if not supported
+    """
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def wait_pids(pids, timeout=None, include_group=False):
+    """
+    Wait until all the processes have exited
+
+    Returns the list of processes still running after the timeout.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+
+    pidfds = {}
+    for pid in pids:
+        fd = open_pidfd(pid)
+        if fd is not None:
+            pidfds[fd] = pid
+
+    try:
+        poller = select.poll()
+        registered = set(pidfds)
+        for fd in registered:
+            poller.register(fd, select.POLLIN)
+
+        remaining = [pid for pid in pids if is_running(pid, include_group)]
+        while len(remaining) > 0:
+            left = None if deadline is None else deadline - time.time()
+            if left is not None and left <= 0:
+                break
+
+            # processes without a pidfd, and processes left in a group
+            # after its leader exited, are checked periodically
+            watched = set(pidfds[fd] for fd in registered)
+            if any(pid not in watched for pid in remaining):
+                left = 0.1 if left is None else min(left, 0.1)
+
+            for fd, event in poller.poll(None if left is None else left * 1000):
+                poller.unregister(fd)
+                registered.remove(fd)
+
+            remaining = [pid for pid in remaining if is_running(pid, include_group)]
+
+        return remaining
+
+    finally:
+        for fd in pidfds:
+            os.close(fd)
+
+
+def waitpid(pid):
+    # this works both for children of the current process and
+    # other processes, e.g. a pane in tmux
+    wait_pids([pid], include_group=True)
+
+
+def get_status():
+    """
+    Get a dict of the known processes and whether they are running
+    """
+    return {pid: is_running(pid) for pid in known_pids}
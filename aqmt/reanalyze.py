@@ -0,0 +1,116 @@
+"""
+This module contains logic for analyzing and plotting all tests
+in an existing result folder, without running the test script
+
+The tests are processed in parallel by a pool of processes.
+"""
+
+import multiprocessing
+import time
+import traceback
+
+from . import logger
+from .plot import collectionutil, generate_hierarchy_data_from_folder, plot_test
+from .testcase import analyze_test
+from .testenv import read_metadata, remove_hint, save_hint_to_folder
+
+
+def get_samples_to_skip(testfolder):
+    """
+    Get the number of samples that was skipped when the test was
+    last analyzed, or if never analyzed the value used when the
+    test was run
+    """
+    metadata_kv, metadata_lines = read_metadata(testfolder + '/details')
+
+    for key in ['analyzed_aggregated_samples_skipped', 'ta_samples_pre']:
+        if key in metadata_kv:
+            return int(metadata_kv[key])
+
+    return 0
+
+
+def process_testcase(testfolder, samples_to_skip=None, plot=True, force=False, detect_steady_state=False):
+    """
+    Analyze and plot a single test
+
+    Returns a dict with the time used for each step and the error
+    message if it failed. Runs in a worker process.
+    """
+    result = {
+        'testcase': testfolder,
+        'analyze_time': None,
+        'plot_time': None,
+        'error': None,
+    }
+
+    try:
+        if samples_to_skip is None:
+            samples_to_skip = get_samples_to_skip(testfolder)
+
+        start = time.time()
+        remove_hint(testfolder, ['data_analyzed', 'analyzed_aggregated_samples_skipped'])
+        samples_to_skip = analyze_test(testfolder, samples_to_skip, force=force, detect_steady_state=detect_steady_state)
+        save_hint_to_folder(testfolder, 'data_analyzed')
+        save_hint_to_folder(testfolder, 'analyzed_aggregated_samples_skipped %d' % samples_to_skip)
+        result['analyze_time'] = time.time() - start
+
+        if plot:
+            start = time.time()
+            plot_test(testfolder)
+            result['plot_time'] = time.time() - start
+
+    except Exception:
+        result['error'] = traceback.format_exc()
+
+    return result
+
+
+def _process_testcase_args(args):
+    return process_testcase(*args)
+
+
+def analyze_folder(folder, workers=None, samples_to_skip=None, plot=True, force=False, detect_steady_state=False):
+    """
+    Analyze (and plot) all tests found in a result folder
+
+    workers: Number of processes to use, defaults to number of CPUs
+      (also when 0)
+    samples_to_skip: Override the number of samples to skip, by default
+      the value stored in each test is used
+    plot: Plot each test after it is analyzed
+    force: Rerun all analysis stages, even those that are up to date
+    detect_steady_state: Skip the samples detected as warm-up in each
+      test, see calc_steady_state.py
+
+    Returns a list of results as returned by process_testcase.
+    """
+    if workers is None or workers == 0:
+        workers = multiprocessing.cpu_count()
+    if workers < 0:
+        raise Exception('The number of processes cannot be negative: %d' % workers)
+
+    tree = generate_hierarchy_data_from_folder(folder)
+    testfolders = collectionutil.get_all_testcases_folders(tree)
+
+    logger.info('Analyzing %d tests using %d processes' % (len(testfolders), workers))
+
+    start = time.time()
+    results = []
+    args = [(testfolder, samples_to_skip, plot, force, detect_steady_state) for testfolder in testfolders]
+
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(_process_testcase_args, args):
+            results.append(result)
+
+            if result['error'] is not None:
+                logger.error('Failed %s:\n%s' % (result['testcase'], result['error']))
+            else:
+                plot_time = '' if result['plot_time'] is None else ', plotted in %.2f s' % result['plot_time']
+                logger.info('[%d/%d] %s: analyzed in %.2f s%s' % (
+                    len(results), len(testfolders), result['testcase'], result['analyze_time'], plot_time))
+
+    failed = [result for result in results if result['error'] is not None]
+    logger.info('Processed %d tests in %.2f s (%d failed)' % (len(results), time.time() - start, len(failed)))
+
+    return results
@@ -0,0 +1,166 @@
+"""
+This module contains logic for reading the aggregated results of
+finished tests, used by steps that decide what to test next based
+on the results of earlier tests (see steps.py)
+
+The metrics available for each test are:
+- util: Total utilization in percent (average)
+- util_ecn, util_nonecn: Utilization of each queue in percent (average)
+- queue_ecn_p99, queue_nonecn_p99: p99 queueing delay of each queue in us
+- queue_ecn_avg, queue_nonecn_avg: Average queueing delay of each queue in us
+- rate_<tag>: Average rate of the traffic with a given tag in b/s
+"""
+
+import math
+import os
+
+from . import logger
+from .testenv import read_metadata
+
+# t-distribution values for 95 % confidence, by degrees of freedom
+T_VALUES = [
+    None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+    2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093,
+    2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045,
+    2.042,
+]
+
+
+def get_t_value(df):
+    return T_VALUES[df] if df < len(T_VALUES) else 1.96
+
+
+def read_stats(file):
+    """
+    Read a stats file with a single row of values, e.g. util_stats
+
+    Returns a dict of column name to value.
+    """
+    with open(file, 'r') as f:
+        header = f.readline().lstrip('#').split()
+        values = f.readline().split()
+
+    return {name: float(value) for name, value in zip(header, values) if value != '-'}
+
+
+def read_tagged_stats(file):
+    """
+    Read a stats file with a row for each tag, e.g. rate_tagged_stats
+
+    Returns a dict of tag to a dict of column name to value.
+    """
+    with open(file, 'r') as f:
+        header = f.readline().lstrip('#').split()[1:]
+        stats = {}
+        for line in f:
+            if line.strip() == '':
+                continue
+            tag, rest = line.rsplit('"', 1)
+            stats[tag.strip('"')] = {name: float(value) for name, value in zip(header, rest.split()) if value != '-'}
+
+    return stats
+
+
+def get_metrics(testfolder):
+    """
+    Get the metrics of an analyzed test as a dict
+    """
+    aggregated = testfolder + '/aggregated/'
+    metrics = {}
+
+    for name in ['util', 'util_ecn', 'util_nonecn']:
+        if os.path.isfile(aggregated + name + '_stats'):
+            metrics[name] = read_stats(aggregated + name + '_stats')['average']
+
+    for queue in ['ecn', 'nonecn']:
+        if os.path.isfile(aggregated + 'queue_%s_stats' % queue):
+            stats = read_stats(aggregated + 'queue_%s_stats' % queue)
+            metrics['queue_%s_avg' % queue] = stats['average']
+            metrics['queue_%s_p99' % queue] = stats['p99']
+
+    if os.path.isfile(aggregated + 'rate_tagged_stats'):
+        for tag, stats in read_tagged_stats(aggregated + 'rate_tagged_stats').items():
+            metrics['rate_%s' % tag] = stats['average']
+
+    return metrics
+
+
+def find_tests(folder):
+    """
+    Get the folders of all tests with data below a folder
+    """
+    tests = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        if 'details' in files:
+            metadata_kv, metadata_lines = read_metadata(root + '/details')
+            if metadata_kv.get('type') == 'test' and 'data_analyzed' in metadata_kv:
+                tests.append(root)
+                dirs[:] = []
+
+    return tests
+
+
+def get_collection_metrics(folder, names=None):
+    """
+    Get the metrics of all tests below a folder, as a dict of
+    (test folder relative to the given folder, metric) to value
+
+    names: List of metrics to include, by default all
+    """
+    metrics = {}
+    for testfolder in find_tests(folder):
+        for name, value in get_metrics(testfolder).items():
+            if names is None or name in names:
+                metrics[(os.path.relpath(testfolder, folder), name)] = value
+
+    return metrics
+
+
+def metric(name):
+    """
+    Get a function returning the average of a metric for all
+    tests below a folder, or None if no test has the metric
+    """
+    def fn(folder):
+        values = [value for (test, metric_name), value in get_collection_metrics(folder, [name]).items()]
+        return sum(values) / len(values) if len(values) > 0 else None
+    return fn
+
+
+def get_half_width(values):
+    """
+    Half-width of the 95 % confidence interval of the mean
+    """
+    n = len(values)
+    mean = sum(values) / n
+    stddev = math.sqrt(sum((value - mean) ** 2 for value in values) / (n - 1))
+    return get_t_value(n - 1) * stddev / math.sqrt(n)
+
+
+def is_converged(repetitions, target):
+    """
+    Check if the confidence interval of the mean of all
+    metrics is within target relative to the mean
+
+    repetitions: List of dicts as returned by get_collection_metrics
+    """
+    if len(repetitions) < 2:
+        return False
+
+    keys = set(repetitions[0])
+    for metrics in repetitions[1:]:
+        keys &= set(metrics)
+
+    if len(keys) == 0:
+        # e.g. the analysis failed or no metric was selected
+        logger.warn('No metrics found in all of the %d repetitions, cannot check convergence' % len(repetitions))
+        return False
+
+    for key in keys:
+        values = [metrics[key] for metrics in repetitions]
+        mean = sum(values) / len(values)
+        if get_half_width(values) > target * abs(mean):
+            return False
+
+    return True
@@ -0,0 +1,231 @@
+"""
+This module contains the logic for recording the time used by each
+phase of a test, and estimating the run time of later tests from
+the recorded history
+
+The time of each phase is stored as duration_<phase> in the details
+file of the test. When estimating a test, the history of the tests
+most similar to it is used, trying the following features in order:
+- the traffic function, AQM, bitrate and RTT
+- the traffic function and AQM
+- the traffic function
+- any test
+
+The number of flows and the traffic types used are given by the
+traffic function, so they are not used as separate features.
+
+The hints used are also recorded in the journal of the campaign when
+a test is finished. For folders with a journal the history is read from
+it, instead of reading the details file of every test in the folder.
+"""
+
+import os
+import time
+
+from . import journal
+from . import logger
+from .testenv import read_metadata, remove_hint, save_hint_to_folder
+
+RUN_PHASES = ['reset', 'setup', 'pre_hook', 'collect', 'post_hook', 'reset_post', 'cooldown']
+ANALYSIS_PHASES = ['analyze', 'plot']
+
+# hints in the details file used by the history, in addition to the durations
+HISTORY_HINTS = [
+    'test_fn', 'testbed_aqm', 'testbed_rate',
+    'testbed_rtt_clients', 'testbed_rtt_servera', 'testbed_rtt_serverb',
+    'ta_samples', 'ta_samples_pre', 'ta_delay', 'early_stop',
+]
+
+
+def save_duration(folder, phase, seconds):
+    remove_hint(folder, ['duration_' + phase])
+    save_hint_to_folder(folder, 'duration_%s %.3f' % (phase, seconds))
+
+
+def get_history_hints(test_folder):
+    """
+    Get the hints of a test used by the history
+    """
+    metadata_kv, metadata_lines = read_metadata(test_folder + '/details')
+    return {
+        key: value for key, value in metadata_kv.items()
+        if key in HISTORY_HINTS or key.startswith('duration_')
+    }
+
+
+def get_features(test_fn_name, aqm_name, bitrate, rtt):
+    """
+    The key used to match similar tests. The bitrate and RTT are
+    normalized, as the history reads them as text from the details
+    file while the testbed might have them as floats
+    """
+    return (str(test_fn_name), str(aqm_name), str(int(float(bitrate))), str(int(round(float(rtt)))))
+
+
+def get_collect_time(ta_samples, ta_samples_pre, ta_delay):
+    """
+    The time the analyzer is expected to run, in seconds
+    """
+    return (ta_samples + ta_samples_pre) * ta_delay / 1000
+
+
+class RuntimeHistory:
+    def __init__(self):
+        self.num_tests = 0
+        self.values = {}  # (features, phase) to list of durations
+
+    def add_folder(self, folder):
+        """
+        Add the history of all tests found in a folder
+        """
+        if not os.path.isdir(folder):
+            return
+
+        if os.path.isfile(folder + '/' + journal.JOURNAL_FILE):
+            for hints in journal.Journal(folder).runtime.values():
+                self.add_test(hints)
+            return
+
+        # results from before the journal was used
+        for root, dirs, files in os.walk(folder):
+            # don't look into the data of the tests
+            for name in ['ta', 'derived', 'aggregated', 'fct']:
+                if name in dirs:
+                    dirs.remove(name)
+
+            if 'details' in files:
+                metadata_kv, metadata_lines = read_metadata(root + '/details')
+                if metadata_kv.get('type') == 'test':
+                    self.add_test(metadata_kv)
+
+    def add_test(self, metadata_kv):
+        if 'duration_collect' not in metadata_kv:
+            return
+
+        rtt = max(float(metadata_kv.get('testbed_rtt_' + node, 0)) for node in ['clients', 'servera', 'serverb'])
+        features = get_features(
+            metadata_kv.get('test_fn'),
+            metadata_kv.get('testbed_aqm'),
+            metadata_kv.get('testbed_rate', 0),
+            rtt,
+        )
+
+        collect_time = get_collect_time(
+            int(metadata_kv['ta_samples']),
+            int(metadata_kv['ta_samples_pre']),
+            int(metadata_kv['ta_delay']),
+        )
+        if 'early_stop' in metadata_kv:
+            # the test was stopped after this number of samples
+            collect_time = get_collect_time(int(metadata_kv['early_stop']), 0, int(metadata_kv['ta_delay']))
+
+        for phase in RUN_PHASES + ANALYSIS_PHASES:
+            key = 'duration_' + phase
+            if key not in metadata_kv:
+                continue
+
+            value = float(metadata_kv[key])
+            if phase == 'collect':
+                # store relative to the expected time, as it mostly
+                # depends on the number of samples
+                value = value / collect_time if collect_time > 0 else 1
+
+            for n in [4, 2, 1, 0]:
+                self.values.setdefault((features[:n], phase), []).append(value)
+
+        self.num_tests += 1
+
+    def estimate_phase(self, features, phase):
+        """
+        Get the average of a phase for the most similar tests,
+        or None if there is no history of the phase
+        """
+        for n in [4, 2, 1, 0]:
+            values = self.values.get((features[:n], phase))
+            if values:
+                return sum(values) / len(values)
+
+        return None
+
+    def estimate(self, features, collect_time, cooldown_time, include_analysis=False, fixed_cooldown=True):
+        """
+        Estimate the run time of a test
+
+        collect_time: The expected time of the analyzer
+        cooldown_time: The (maximum) time waited after the test
+        include_analysis: Include analyzing and plotting the test
+        fixed_cooldown: The cooldown is a fixed sleep, otherwise it
+          lasts until the testbed is idle and is estimated from history
+        """
+        phases = RUN_PHASES + (ANALYSIS_PHASES if include_analysis else [])
+
+        total = 0
+        for phase in phases:
+            value = self.estimate_phase(features, phase)
+            if phase == 'collect':
+                total += collect_time * (value if value is not None else 1)
+            elif phase == 'cooldown' and (fixed_cooldown or value is None):
+                total += cooldown_time
+            elif value is not None:
+                total += value
+
+        return total
+
+
+class CampaignProgress:
+    """
+    Keeps track of the tests remaining when running, and logs
+    the estimated time left after each test
+    """
+
+    def __init__(self, tests):
+        """
+        tests: List of PlannedTest from the dry run
+        """
+        self.remaining = {
+            test.collection.folder + '/test': test.estimated_time
+            for test in tests if test.will_test and not test.is_dynamic()
+        }
+
+        # the folders of the tests below dynamic branches are not known,
+        # so their estimates are used by any test finished below the
+        # collection having the dynamic branches
+        self.placeholders = {}  # folder of collection -> list of estimated time
+        for test in tests:
+            if test.will_test and test.is_dynamic():
+                self.placeholders.setdefault(test.collection.dynamic_parent, []).append(test.estimated_time)
+
+        self.num_tests = len(self.remaining) + sum(len(times) for times in self.placeholders.values())
+        self.num_finished = 0
+        self.estimated_done = 0
+        self.start = time.time()
+
+    def pop_estimate(self, test_folder):
+        """
+        Get and remove the estimated time of a test, or None if unknown
+        """
+        if test_folder in self.remaining:
+            return self.remaining.pop(test_folder)
+
+        for folder, times in self.placeholders.items():
+            if test_folder.startswith(folder + '/') and len(times) > 0:
+                return times.pop()
+
+        return None
+
+    def test_finished(self, test_folder):
+        estimate = self.pop_estimate(test_folder)
+        if estimate is None:
+            return
+
+        self.estimated_done += estimate
+        self.num_finished += 1
+        elapsed = time.time() - self.start
+
+        # correct the estimate by how far off it has been so far
+        remaining = sum(self.remaining.values()) + sum(sum(times) for times in self.placeholders.values())
+        if self.estimated_done > 0:
+            remaining *= elapsed / self.estimated_done
+
+        logger.info('Finished %d of %d tests in %d s, estimated %d s remaining' % (
+            self.num_finished, self.num_tests, elapsed, remaining))
@@ -0,0 +1,113 @@
+"""
+This module contains the logic for keeping SSH connections to the
+clients and servers open while running tests
+
+One SSH master connection is kept to each node, and the SSH commands
+run by the framework are multiplexed over it instead of connecting
+every time. The options needed to use the connections are exported
+as AQMT_SSH_OPTIONS, which is used by aqmt-testbed.sh and the
+traffic generators. Without the pool these are empty and SSH
+connects as usual (possibly using ControlMaster in ssh_config).
+"""
+
+import getpass
+import os
+import shutil
+import tempfile
+from plumbum import local
+
+from . import logger
+
+NODES = ['CLIENTA', 'CLIENTB', 'SERVERA', 'SERVERB']
+
+OPTIONS_ENV = 'AQMT_SSH_OPTIONS'
+
+
+def get_ssh():
+    """
+    Get the ssh command using the pool if it is running
+    """
+    return local['ssh'][os.environ.get(OPTIONS_ENV, '').split()]
+
+
+class SshPool:
+    def __init__(self, user='root', nodes=None):
+        self.user = user
+        self.nodes = nodes if nodes is not None else NODES
+        self.control_dir = None
+
+    def get_hosts(self):
+        """
+        The testbed script connects as the given user, while the traffic
+        generators connect as the local user, so keep a connection for
+        both as the connections are shared by user and host
+        """
+        hosts = []
+        for node in self.nodes:
+            ip = os.environ['IP_%s_MGMT' % node]
+            hosts.append('%s@%s' % (self.user, ip))
+            if getpass.getuser() != self.user:
+                hosts.append(ip)
+        return hosts
+
+    def get_options(self):
+        # if a master dies between checks, the next command becomes the new master
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s/%%r@%%h:%%p' % self.control_dir,
+            '-o', 'ControlPersist=yes',
+        ]
+
+    def start(self):
+        self.control_dir = tempfile.mkdtemp(prefix='aqmt-ssh-')
+        os.environ[OPTIONS_ENV] = ' '.join(self.get_options())
+
+        for host in self.get_hosts():
+            self.connect(host)
+
+    def connect(self, host):
+        cmd = local['ssh'][
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPath=%s/%%r@%%h:%%p' % self.control_dir,
+            '-o', 'ControlPersist=yes',
+            '-o', 'ServerAliveInterval=5',
+            '-o', 'ServerAliveCountMax=3',
+            '-fN', host,
+        ]
+
+        retcode, stdout, stderr = cmd.run(retcode=None)
+        if retcode != 0:
+            logger.warn('Could not open SSH connection to %s: %s' % (host, stderr.strip()))
+            return False
+
+        logger.debug('Opened SSH connection to %s' % host)
+        return True
+
+    def is_alive(self, host):
+        cmd = local['ssh'][self.get_options()]['-O', 'check', host]
+        return cmd.run(retcode=None)[0] == 0
+
+    def check(self):
+        """
+        Reconnect to any node that has lost its connection
+
+        Returns False if a node could not be connected to.
+        """
+        ok = True
+        for host in self.get_hosts():
+            if not self.is_alive(host):
+                logger.warn('SSH connection to %s lost, reconnecting' % host)
+                ok = self.connect(host) and ok
+        return ok
+
+    def stop(self):
+        if self.control_dir is None:
+            return
+
+        # also stop connections opened by commands if a connection was lost
+        for name in os.listdir(self.control_dir):
+            local['ssh']['-o', 'ControlPath=%s/%s' % (self.control_dir, name), '-O', 'exit', 'aqmt'].run(retcode=None)
+
+        del os.environ[OPTIONS_ENV]
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        self.control_dir = None
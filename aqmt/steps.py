@@ -12,10 +12,25 @@ A step is required to yield (minimum one time) in two different ways:
   - tag
   - title
   - titlelabel
+  - hints (optional): list of additional lines to save in the
+    details file of the branch
+  - dynamic (optional): True if the branches depend on the results
+    of earlier tests, so the branches yielded in the dry run are only
+    placeholders. The tests below them are not in the plan file, and
+    are added to the journal when they are run.
+
+Steps that use the results of the tests after yielding (e.g. plotting
+the collection) must call testdef.collection.wait_for_analysis() first,
+as tests might be analyzed in the background, or not run yet if a
+scheduler is used (see testplan.py).
 """
 
+import math
 import os.path
+import random
 
+from . import logger
+from . import results
 from .plot import generate_hierarchy_data_from_folder, \
                   plot_folder_flows, plot_folder_compare, \
                   reorder_levels
@@ -77,6 +92,203 @@ def branch_repeat(num, title='%d', titlelabel='Test #'):
     return step
 
 
+def branch_repeat_adaptive(max_num, min_num=3, target=0.05, metrics=None, title='%d', titlelabel='Test #'):
+    """
+    Repeat the tests until the results are stable, instead
+    of a fixed number of times
+
+    After each repetition the confidence interval of the mean of
+    each metric across the repetitions is calculated, and no more
+    repetitions are run when all are within the target. The
+    metrics are compared for each test inside the repetitions.
+
+    max_num: Maximum number of repetitions
+    min_num: Minimum number of repetitions
+    target: Maximum half-width of the 95 % confidence interval
+      relative to the mean, e.g. 0.05
+    metrics: List of metrics to use, by default all (see results.py)
+
+    The estimated time before running the tests assumes all
+    repetitions are needed.
+    """
+    def step(testdef):
+        repetitions = []
+        for i in range(max_num):
+            yield {
+                'tag': 'repeat-%d' % i,
+                'title': title % (i + 1),
+                'titlelabel': titlelabel,
+            }
+
+            if testdef.dry_run:
+                continue
+
+            testdef.collection.wait_for_analysis()
+            repetitions.append(results.get_collection_metrics(testdef.collection.folder + '/repeat-%d' % i, metrics))
+
+            if i + 1 >= min_num and results.is_converged(repetitions, target):
+                logger.info('Results of %s converged after %d repetitions' % (testdef.collection.folder, i + 1))
+                break
+    return step
+
+
+def branch_search(fn_testdef, low, high, fn_metric, target, max_tests=8,
+        resolution=None, log=False, title='%g', titlelabel=''):
+    """
+    Search for the parameter value where a metric crosses a target,
+    instead of testing a full list of values
+
+    The metric must be monotonic in the parameter. The range limits
+    are tested first, and then the range is bisected towards the
+    value crossing the target. The branches are sorted by value
+    when the search is done, so they are plotted in order.
+
+    fn_testdef: Function receiving testdef and the value to test
+    fn_metric: Function receiving the folder of a branch returning the
+      value of the metric, e.g. results.metric('rate_udp')
+    max_tests: Maximum number of values to test
+    resolution: If set, values are rounded to a multiple of this and
+      the search stops when the range is this small
+    log: Bisect on a logarithmic scale
+
+    The estimated time before running the tests assumes all
+    max_tests values are needed. As the values are not known before
+    the tests are run, the tests of the search are not in plan.json,
+    and are added to journal.jsonl when they are run.
+    """
+    def get_tag(value):
+        return 'search-%g' % value
+
+    def get_middle(a, b):
+        value = math.sqrt(a * b) if log else (a + b) / 2
+        if resolution is not None:
+            value = round(value / resolution) * resolution
+        return value
+
+    def branch(testdef, value):
+        fn_testdef(testdef, value)
+        return {
+            'tag': get_tag(value),
+            'title': title % value,
+            'titlelabel': titlelabel,
+            'dynamic': True,
+        }
+
+    def step(testdef):
+        if testdef.dry_run:
+            # we don't know the values without the results,
+            # so use values spread over the range instead
+            for i in range(max_tests):
+                if log:
+                    value = low * (high / low) ** (i / max(max_tests - 1, 1))
+                else:
+                    value = low + (high - low) * i / max(max_tests - 1, 1)
+                yield branch(testdef, value)
+            return
+
+        values = {}  # tag -> value
+        metrics = {}  # tag -> metric
+
+        def test(value):
+            yield branch(testdef, value)
+            testdef.collection.wait_for_analysis()
+            values[get_tag(value)] = value
+            metrics[get_tag(value)] = fn_metric(testdef.collection.folder + '/' + get_tag(value))
+
+        def is_above(value):
+            return metrics[get_tag(value)] > target
+
+        range_low, range_high = low, high
+
+        yield from test(low)
+        if max_tests > 1:
+            yield from test(high)
+
+        if None in metrics.values():
+            logger.warn('Search in %s stopped: Missing results' % testdef.collection.folder)
+        elif len(metrics) > 1 and is_above(low) == is_above(high):
+            logger.warn('Search in %s stopped: Target %g not crossed in the range' % (
+                testdef.collection.folder, target))
+        else:
+            while len(metrics) < max_tests:
+                value = get_middle(range_low, range_high)
+                if get_tag(value) in metrics or (resolution is not None and range_high - range_low <= resolution):
+                    break
+
+                yield from test(value)
+                if metrics[get_tag(value)] is None:
+                    logger.warn('Search in %s stopped: Missing results' % testdef.collection.folder)
+                    break
+
+                if is_above(value) == is_above(range_low):
+                    range_low = value
+                else:
+                    range_high = value
+
+            logger.info('Search in %s found target %g between %g and %g' % (
+                testdef.collection.folder, target, range_low, range_high))
+
+        testdef.collection.sort_children(key=lambda tag: values.get(tag, math.inf))
+    return step
+
+
+def branch_sample(params, num, fn_testdef, x_param=None, seed=1,
+        title='%g', titlelabel=None):
+    """
+    Test a number of sampled combinations of parameters, instead of
+    nesting a branch for each parameter testing all combinations
+
+    The values are sampled with Latin hypercube sampling, so the
+    range of each parameter is split in num intervals of equal
+    probability and each interval is sampled once. The sampled values
+    are saved as sample_<name> in the details file of each branch.
+
+    The branches are a flat collection ordered by one of the parameters,
+    which is used as the title, so they can be plotted with a linear or
+    logarithmic x axis (see plot_compare).
+
+    params: List of (name, low, high) or (name, low, high, 'log') to
+      sample on a logarithmic scale
+    num: Number of combinations to test
+    fn_testdef: Function receiving testdef and a dict of the values
+    x_param: Name of the parameter used as title, by default the first
+    seed: Seed of the sampling, so the dry run and the test use
+      the same values
+    """
+    if x_param is None:
+        x_param = params[0][0]
+
+    if titlelabel is None:
+        titlelabel = x_param
+
+    def get_samples():
+        rng = random.Random(seed)
+        samples = [{} for i in range(num)]
+
+        for name, low, high, *scale in params:
+            intervals = list(range(num))
+            rng.shuffle(intervals)
+            for sample, interval in zip(samples, intervals):
+                x = (interval + rng.random()) / num
+                if scale == ['log']:
+                    sample[name] = low * (high / low) ** x
+                else:
+                    sample[name] = low + (high - low) * x
+
+        return sorted(samples, key=lambda sample: sample[x_param])
+
+    def step(testdef):
+        for i, sample in enumerate(get_samples()):
+            fn_testdef(testdef, sample)
+            yield {
+                'tag': 'sample-%d' % i,
+                'title': title % sample[x_param],
+                'titlelabel': titlelabel,
+                'hints': ['sample_%s %g' % (name, value) for name, value in sample.items()],
+            }
+    return step
+
+
 def branch_rtt(rtt_list, title='%d', titlelabel='RTT'):
     def step(testdef):
         for rtt in rtt_list:
@@ -180,16 +392,20 @@ def add_post_hook(fn):
 def plot_compare(**plot_args):
     def step(testdef):
         yield
-        if not testdef.dry_run and os.path.isdir(testdef.collection.folder):
-            plot_folder_compare(testdef.collection.folder, **plot_args)
+        if not testdef.dry_run:
+            testdef.collection.wait_for_analysis()
+            if os.path.isdir(testdef.collection.folder):
+                plot_folder_compare(testdef.collection.folder, **plot_args)
     return step
 
 
 def plot_flows(**plot_args):
     def step(testdef):
         yield
-        if not testdef.dry_run and os.path.isdir(testdef.collection.folder):
-            plot_folder_flows(testdef.collection.folder, **plot_args)
+        if not testdef.dry_run:
+            testdef.collection.wait_for_analysis()
+            if os.path.isdir(testdef.collection.folder):
+                plot_folder_flows(testdef.collection.folder, **plot_args)
     return step
 
 
@@ -209,15 +425,17 @@ def html_index(level_order=None):
     def step(testdef):
         yield
 
-        if not testdef.dry_run and os.path.isdir(testdef.collection.folder):
-            tree = reorder_levels(
-                generate_hierarchy_data_from_folder(testdef.collection.folder),
-                level_order=level_order,
-            )
+        if not testdef.dry_run:
+            testdef.collection.wait_for_analysis()
+            if os.path.isdir(testdef.collection.folder):
+                tree = reorder_levels(
+                    generate_hierarchy_data_from_folder(testdef.collection.folder),
+                    level_order=level_order,
+                )
 
-            out = build_html_index(tree, testdef.collection.folder)
+                out = build_html_index(tree, testdef.collection.folder)
 
-            with open(testdef.collection.folder + '/analysis.html', 'w') as f:
-                f.write(out)
+                with open(testdef.collection.folder + '/analysis.html', 'w') as f:
+                    f.write(out)
 
     return step
\ No newline at end of file
@@ -40,7 +40,9 @@ class Terminal:
 
     def run_bg(self, cmd):
         cmd = get_shell_cmd(cmd)
-        p = bash['-c', cmd].popen(stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=True)
+        # in its own process group so it can be stopped with its children
+        p = bash['-c', cmd].popen(stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=True,
+                                  start_new_session=True)
 
         logger.trace('RUN_BG (PID: %d): %s' % (p.pid, get_log_cmd(cmd, prefix='')))
         return p.pid
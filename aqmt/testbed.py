@@ -2,25 +2,116 @@
 This module contains the testbed logic
 """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import math
 import os
+import time
 from plumbum import local, FG
 from plumbum.cmd import bash
-from plumbum.commands.processes import ProcessExecutionError
 
 from . import logger
 from .terminal import get_log_cmd
 
 
+class TestbedError(Exception):
+    """
+    The testbed failed, e.g. a reset or setup failed or the
+    connection to a node was lost. A test failing with this
+    error might succeed if it is run again.
+    """
+    pass
+
+
+# the configuration last applied by Testbed.setup(), or None if the
+# testbed has been reset or its state is unknown
+applied_config = None
+
+
 def get_testbed_script_path():
     return "aqmt-testbed.sh"
 
 
+def run_tasks(title, tasks, dry_run=False, log_level=logger.DEBUG, first_tasks=None):
+    """
+    Run groups of commands from the testbed script concurrently
+
+    Each group is run in order in its own bash process, and is
+    usually the commands for one node.
+
+    tasks: Ordered dict of name to list of commands
+    first_tasks: Ordered dict of groups run one at a time before the
+      other groups, for commands touching more than one node
+
+    Returns False if any of the groups failed.
+    """
+    if first_tasks is not None:
+        for name, task_cmds in first_tasks.items():
+            if not run_tasks(title, OrderedDict([(name, task_cmds)]), dry_run=dry_run, log_level=log_level):
+                return False
+
+    def get_cmd(name, cmds):
+        return bash['-c', """
+            # """ + title + """: """ + name + """
+            set -e
+            source """ + get_testbed_script_path() + """
+
+            """ + '\n            '.join(cmds) + """
+            """]
+
+    if len(tasks) == 0:
+        return True
+
+    cmds = OrderedDict((name, get_cmd(name, task_cmds)) for name, task_cmds in tasks.items())
+    for cmd in cmds.values():
+        logger.log(log_level, get_log_cmd(cmd))
+
+    if dry_run:
+        return True
+
+    def run(name):
+        retcode, stdout, stderr = cmds[name].run(retcode=None)
+        if retcode != 0:
+            logger.error('Failed %s on %s (exit code %d):\n%s' % (title, name, retcode, (stdout + stderr).strip()))
+        return retcode == 0
+
+    with ThreadPoolExecutor(max_workers=len(cmds)) as pool:
+        results = list(pool.map(run, cmds.keys()))
+
+    return all(results)
+
+
 def require_on_aqm_node():
     testbed_script = get_testbed_script_path()
     bash['-c', 'set -e; source %s; require_on_aqm_node' % testbed_script] & FG
 
 
+# interfaces on the AQM node carrying the test traffic
+BOTTLENECK_IFACES = ['IFACE_CLIENTS', 'IFACE_SERVERA', 'IFACE_SERVERB']
+
+
+def get_qdisc_backlog(ifaces):
+    """
+    Get the number of packets queued in the root qdiscs of
+    interfaces on the AQM node (which includes their children)
+    """
+    testbed_script = get_testbed_script_path()
+    res = bash['-c', 'set -e; source %s; get_qdisc_backlog %s' % (testbed_script, ' '.join(ifaces))]()
+    return int(res.strip())
+
+
+def get_iface_packets(iface):
+    """
+    Get the total number of packets sent and received by an interface
+    """
+    total = 0
+    for name in ['tx_packets', 'rx_packets']:
+        with open('/sys/class/net/%s/statistics/%s' % (iface, name)) as f:
+            total += int(f.read())
+    return total
+
+
 class Testbed:
     """
     A object representing the desired testbed configuration and utilities
@@ -57,7 +148,12 @@ class Testbed:
         # time to skip in seconds when building aggregated data, default to be RTT-dependent
         self.ta_idle = idle
 
+        # number of analyzers capturing the traffic, each on its own core
+        # and for a part of the flows, merged after the test (see merge_ta.py)
+        self.ta_shards = 1
+
         self.traffic_port = 5500
+        self.ports_in_use = {}  # node to set of ports, see get_ports_in_use()
 
     def aqm(self, name='', params=''):
         if name == 'pfifo':
@@ -93,55 +189,212 @@ class Testbed:
         samples = time * 1000 / self.ta_delay
         return math.ceil(samples)
 
-    def setup(self, dry_run=False, log_level=logger.DEBUG):
-        cmd = bash['-c', """
-            # configuring testbed
-            set -e
-            source """ + get_testbed_script_path() + """
+    def get_config(self):
+        """
+        Get the configuration applied by setup(), grouped by the
+        part of the testbed it is applied to
+        """
+        return OrderedDict([
+            ('clients_edge', (self.bitrate, self.rtt_clients, self.aqm_name, self.aqm_params, self.netem_clients_params)),
+            ('servera_edge', (self.rtt_servera, self.netem_servera_params)),
+            ('serverb_edge', (self.rtt_serverb, self.netem_serverb_params)),
+            ('cc_a', (self.cc_a, self.ecn_a)),
+            ('cc_b', (self.cc_b, self.ecn_b)),
+        ])
+
+    def get_config_hash(self):
+        return hashlib.sha1(repr(list(self.get_config().items())).encode()).hexdigest()
 
-            set_offloading off
+    @staticmethod
+    def get_setup_cost(applied_config, config):
+        """
+        Get the relative cost of applying a configuration, counted as
+        the number of remote hosts that has to be configured
+
+        applied_config: The configuration currently applied, or None
+          if the testbed is reset
+        """
+        costs = {
+            'clients_edge': 4,  # both clients are reset and configured
+            'servera_edge': 2,
+            'serverb_edge': 2,
+            'cc_a': 2,
+            'cc_b': 2,
+        }
+
+        if applied_config is None:
+            return sum(costs.values())
+
+        return sum(costs[key] for key, value in config.items() if applied_config[key] != value)
+
+    def get_setup_tasks(self, changed, reuse=False):
+        """
+        Get the commands to apply the given parts of the configuration,
+        grouped by the node they configure so they can run concurrently
+
+        reuse: The parts not changed are already applied. The parts that
+          changed are reset before they are configured again.
+
+        The AQM is always recreated, so it does not keep any
+        state (e.g. drop probability) from a previous test.
+        """
+        tasks = OrderedDict()
+        tasks['clients_edge'] = ['reset_aqm_client_edge'] if reuse else []
+        if 'clients_edge' in changed:
+            if reuse:
+                tasks['clients_edge'].append('reset_host $IP_CLIENTA_MGMT $IFACE_ON_CLIENTA')
+                tasks['clients_edge'].append('reset_host $IP_CLIENTB_MGMT $IFACE_ON_CLIENTB')
+            tasks['clients_edge'].append('configure_clients_edge %s %s %s "%s" "%s"' % (self.bitrate, self.rtt_clients, self.aqm_name, self.aqm_params, self.netem_clients_params))
+        else:
+            tasks['clients_edge'].append('configure_clients_edge_aqm_node %s %s %s "%s" "%s"' % (self.bitrate, self.rtt_clients, self.aqm_name, self.aqm_params, self.netem_clients_params))
+
+        for node, rtt, netem_params in [('A', self.rtt_servera, self.netem_servera_params), ('B', self.rtt_serverb, self.netem_serverb_params)]:
+            if 'server%s_edge' % node.lower() in changed:
+                task = tasks['server%s_edge' % node.lower()] = []
+                if reuse:
+                    task.append('reset_server_edge $IP_SERVER{0}_MGMT $IFACE_SERVER{0} $IFACE_ON_SERVER{0}'.format(node))
+                task.append('configure_server_edge $IP_SERVER{0}_MGMT $IP_AQM_S{0} $IFACE_SERVER{0} $IFACE_ON_SERVER{0} '.format(node) + '%s "%s"' % (rtt, netem_params))
+
+        for node, cc, ecn in [('A', self.cc_a, self.ecn_a), ('B', self.cc_b, self.ecn_b)]:
+            if 'cc_%s' % node.lower() in changed:
+                for host in ['CLIENT' + node, 'SERVER' + node]:
+                    tasks['%s_cc' % host.lower()] = ['configure_host_cc $IP_%s_MGMT %s %s' % (host, cc, ecn)]
+
+        return tasks
+
+    def setup(self, dry_run=False, log_level=logger.DEBUG, reuse=False):
+        """
+        Apply the configuration to the testbed
+
+        reuse: If the testbed was set up and not reset since, only apply
+          the parts of the configuration that have changed. The parts that
+          changed are reset before they are configured again.
+        """
+        global applied_config
+
+        config = self.get_config()
+
+        # the offloading is changed on the interfaces of all nodes,
+        # so it is done before the nodes are configured
+        first_tasks = OrderedDict()
+
+        if reuse and applied_config is not None:
+            changed = [key for key, value in config.items() if applied_config[key] != value]
+            logger.debug('Reusing testbed setup, changed parts: %s' % (', '.join(changed) or 'none'))
+            tasks = self.get_setup_tasks(changed, reuse=True)
+        else:
+            first_tasks['offloading'] = ['set_offloading off']
+            tasks = self.get_setup_tasks(list(config.keys()))
 
-            configure_clients_edge """ + '%s %s %s "%s" "%s"' % (self.bitrate, self.rtt_clients, self.aqm_name, self.aqm_params, self.netem_clients_params) + """
-            configure_server_edge $IP_SERVERA_MGMT $IP_AQM_SA $IFACE_SERVERA $IFACE_ON_SERVERA """ + '%s "%s"' % (self.rtt_servera, self.netem_servera_params) + """
-            configure_server_edge $IP_SERVERB_MGMT $IP_AQM_SB $IFACE_SERVERB $IFACE_ON_SERVERB """ + '%s "%s"' % (self.rtt_serverb, self.netem_serverb_params) + """
+        if not dry_run:
+            applied_config = None
 
-            configure_host_cc $IP_CLIENTA_MGMT """ + '%s %s' % (self.cc_a, self.ecn_a) + """
-            configure_host_cc $IP_SERVERA_MGMT """ + '%s %s' % (self.cc_a, self.ecn_a) + """
-            configure_host_cc $IP_CLIENTB_MGMT """ + '%s %s' % (self.cc_b, self.ecn_b) + """
-            configure_host_cc $IP_SERVERB_MGMT """ + '%s %s' % (self.cc_b, self.ecn_b) + """
-            """]
+        if not run_tasks('configuring testbed', tasks, dry_run=dry_run, log_level=log_level, first_tasks=first_tasks):
+            return False
 
-        logger.log(log_level, get_log_cmd(cmd))
         if not dry_run:
-            try:
-                cmd & FG
-            except ProcessExecutionError:
-                return False
+            applied_config = config
 
         return True
 
     @staticmethod
-    def reset(dry_run=False, log_level=logger.DEBUG):
-        cmd = bash['-c', """
-            # resetting testbed
-            set -e
-            source """ + get_testbed_script_path() + """
+    def reset(dry_run=False, log_level=logger.DEBUG, keep_setup=False):
+        """
+        Stop all traffic and reset the testbed
 
-            kill_all_traffic
-            reset_aqm_client_edge
-            reset_aqm_server_edge
-            reset_all_hosts_edge
-            reset_all_hosts_cc
-            """]
+        keep_setup: Only stop the traffic, and keep the configuration
+          so it can be reused by the next setup()
+        """
+        global applied_config
 
-        logger.log(log_level, get_log_cmd(cmd))
-        if not dry_run:
-            try:
-                cmd & FG
-            except ProcessExecutionError:
-                return False
+        keep_setup = keep_setup and applied_config is not None
 
-        return True
+        # the traffic is stopped before anything is reset
+        first_tasks = OrderedDict()
+        first_tasks['kill_traffic'] = ['kill_traffic $IP_%s_MGMT' % host for host in ['CLIENTA', 'CLIENTB', 'SERVERA', 'SERVERB']]
+
+        tasks = OrderedDict()
+        if not keep_setup:
+            tasks['aqm'] = ['reset_aqm_client_edge', 'reset_aqm_server_edge']
+
+            for host in ['CLIENTA', 'CLIENTB', 'SERVERA', 'SERVERB']:
+                tasks[host.lower()] = [
+                    'reset_host $IP_{0}_MGMT $IFACE_ON_{0}'.format(host),
+                    'configure_host_cc $IP_%s_MGMT cubic 2' % host,
+                ]
+
+        if not dry_run and not keep_setup:
+            applied_config = None
+
+        return run_tasks('stopping traffic' if keep_setup else 'resetting testbed', tasks, dry_run=dry_run, log_level=log_level,
+                         first_tasks=first_tasks)
+
+    @staticmethod
+    def wait_until_idle(dry_run=False, timeout=10, interval=0.1, max_packets=2):
+        """
+        Wait until the queues on the AQM node are empty and there is
+        no more traffic through it, e.g. after the traffic is stopped
+
+        timeout: Maximum time to wait in seconds
+        interval: Time between each check in seconds
+        max_packets: Packets allowed to pass during an interval while idle
+
+        Returns the time waited, or None if not idle before the timeout
+        """
+        if dry_run:
+            return 0
+
+        ifaces = [os.environ[name] for name in BOTTLENECK_IFACES]
+        start = time.time()
+
+        packets = sum(get_iface_packets(iface) for iface in ifaces)
+        while True:
+            time.sleep(interval)
+
+            prev_packets = packets
+            packets = sum(get_iface_packets(iface) for iface in ifaces)
+            backlog = get_qdisc_backlog(ifaces)
+
+            waited = time.time() - start
+            if backlog == 0 and packets - prev_packets <= max_packets:
+                logger.debug('Testbed idle after %.2f s' % waited)
+                return waited
+
+            if waited >= timeout:
+                logger.warn('Testbed not idle after %.2f s (%d packets queued)' % (waited, backlog))
+                return None
+
+    @staticmethod
+    def is_setup_applied():
+        return applied_config is not None
+
+    @staticmethod
+    def get_applied_config():
+        return applied_config
+
+    def get_ports_in_use(self, node):
+        """
+        Get the set of ports in use on a node
+
+        The ports are only fetched from the node the first time, and
+        are then kept until clear_ports_in_use() is called, which
+        is done before each test.
+        """
+        if node not in self.ports_in_use:
+            if 'CLIENT' not in node and 'SERVER' not in node:
+                raise Exception('Expecting node name like CLIENTA. Got: %s' % node)
+
+            res = bash['-c', """
+                set -e
+                source """ + get_testbed_script_path() + """
+                get_ports_in_use $IP_""" + node + """_MGMT 2>/dev/null
+                """]()
+            self.ports_in_use[node] = set(int(port) for port in res.split() if port.isdigit())
+
+        return self.ports_in_use[node]
+
+    def clear_ports_in_use(self):
+        self.ports_in_use = {}
 
     def get_next_traffic_port(self, node_to_check=None):
         while True:
@@ -149,21 +402,14 @@ class Testbed:
             self.traffic_port += 1
 
             if node_to_check is not None:
-                if 'CLIENT' not in node_to_check and 'SERVER' not in node_to_check:
-                    raise Exception('Expecting node name like CLIENTA. Got: %s' % node_to_check)
-                host = '$IP_%s_MGMT' % node_to_check
-                import time
-                start = time.time()
-                res = bash['-c', """
-                    set -e
-                    source """ + get_testbed_script_path() + """
-                    check_port_in_use """ + host + """ """ + str(tmp) + """ 2>/dev/null
-                    """]()
-                if int(res) > 0:
+                ports_in_use = self.get_ports_in_use(node_to_check)
+                if tmp in ports_in_use:
                     # port in use, try next
                     logger.warn('Port %d on node %s was in use - will try next port' % (tmp, node_to_check))
                     continue
 
+                ports_in_use.add(tmp)
+
             break
 
         return tmp
@@ -2,8 +2,10 @@
 This module contains the individual test case logic
 """
 
+from contextlib import contextmanager
 from datetime import datetime
 import functools
+import math
 import os
 from plumbum import local
 from plumbum.cmd import bash
@@ -11,32 +13,56 @@ import re
 import shutil
 import time
 
+from . import calc_fct
 from . import calc_queuedelay
+from . import calc_steady_state
 from . import calc_tagged_rate
 from . import calc_utilization
 from . import calc_window
+from . import journal
 from . import logger
+from . import merge_ta
 from . import processes
+from . import runtime
+from . import timeline
+from .agent import close_agents
+from .convergence import ConvergenceMonitor
+from .fingerprint import AnalysisStages
 from .terminal import get_log_cmd
-from .testenv import get_pid_ta, remove_hint, save_hint_to_folder, set_pid_ta, read_metadata
+from .testbed import TestbedError
+from .testdata import TestData
+from .testenv import get_pid_ta, read_metadata, remove_hint, save_hint_to_folder, set_pid_ta, set_test_folder
+from .testplan import get_name
 
 
-def analyze_test(testfolder, samples_to_skip):
-    bitrate = 0
-    with open(testfolder + '/details', 'r') as f:
-        for line in f:
-            if line.startswith('testbed_rate'):
-                bitrate = int(line.split()[1])
-                break
+def analyze_test(testfolder, samples_to_skip, force=False, detect_steady_state=False):
+    """
+    Analyze a test, generating the derived and aggregated data
 
+    Stages whose inputs have not changed since the last analysis are
+    skipped, unless force is given. See fingerprint.py.
+
+    detect_steady_state: Skip the samples detected as warm-up in the
+      aggregated data instead of samples_to_skip. See calc_steady_state.py.
+
+    Returns the number of samples skipped in the aggregated data
+    """
+
+    # all the python stages share the parsed data so each file
+    # is only read once
+    data = TestData(testfolder)
+    metadata_kv, metadata_lines = data.get_details()
+
+    bitrate = int(metadata_kv['testbed_rate']) if 'testbed_rate' in metadata_kv else 0
     if bitrate == 0:
         raise Exception("Could not determine bitrate of test '%s'" % testfolder)
 
     # FIXME: properly handle rtt for different queues/servers
-    metadata_kv, metadata_lines = read_metadata(testfolder + '/details')
     rtt_l4s = float(metadata_kv['testbed_rtt_servera']) + float(metadata_kv['testbed_rtt_clients'])
     rtt_classic = float(metadata_kv['testbed_rtt_servera']) + float(metadata_kv['testbed_rtt_clients'])
 
+    traffic = [key + ' ' + value for key, value in metadata_lines if key.startswith('traffic=')]
+
     # the derived folder contains per sample data derived data
     # from analyzer data
     if not os.path.exists(testfolder + '/derived'):
@@ -47,20 +73,107 @@ def analyze_test(testfolder, samples_to_skip):
     if not os.path.exists(testfolder + '/aggregated'):
         os.makedirs(testfolder + '/aggregated')
 
+    def ta(*names):
+        return [testfolder + '/ta/' + name for name in names]
+
+    def out(*names):
+        return [testfolder + '/' + name for name in names]
+
+    def run_program(cmd):
+        def fn():
+            logger.debug(get_log_cmd(cmd))
+            cmd()
+        return fn
+
+    python_code = [os.path.join(os.path.dirname(__file__), 'testdata.py')]
+    ecn_types = ['ecn00', 'ecn01', 'ecn10', 'ecn11']
+
+    stages = AnalysisStages(testfolder, force=force)
+
+    stages.run(
+        'calc_steady_state',
+        functools.partial(calc_steady_state.process_test, testfolder, data=data),
+        code=python_code + [calc_steady_state.__file__],
+        inputs=ta('rate_ecn', 'rate_nonecn', *['queue_packets_' + ecn for ecn in ecn_types]),
+    )
+
+    if detect_steady_state:
+        metadata_kv, metadata_lines = read_metadata(testfolder + '/details')
+        samples_to_skip = int(metadata_kv['steady_state_samples'])
+        logger.debug('Using detected warm-up of %d samples for %s' % (samples_to_skip, testfolder))
+
     program = os.path.join(os.path.dirname(__file__), 'calc_queue_packets_drops')
-    cmd = local[program][testfolder, str(samples_to_skip)]
-    logger.debug(get_log_cmd(cmd))
-    cmd()
+    stages.run(
+        'calc_queue_packets_drops',
+        run_program(local[program][testfolder, str(samples_to_skip)]),
+        code=[program],
+        inputs=ta(*['queue_%s_%s' % (kind, ecn) for kind in ['packets', 'drops'] for ecn in ecn_types]),
+        params=[samples_to_skip],
+        outputs=out(*['aggregated/queue_packets_drops_%s_%s' % (ecn, kind) for ecn in ['ecn', 'nonecn'] for kind in ['pdf', 'cdf']]),
+    )
 
     program = os.path.join(os.path.dirname(__file__), 'calc_basic')
-    cmd = local[program][testfolder, str(bitrate), str(rtt_l4s), str(rtt_classic), str(samples_to_skip)]
-    logger.debug(get_log_cmd(cmd))
-    cmd()
+    stages.run(
+        'calc_basic',
+        run_program(local[program][testfolder, str(bitrate), str(rtt_l4s), str(rtt_classic), str(samples_to_skip)]),
+        code=[program],
+        inputs=ta('rate_ecn', 'rate_nonecn', 'marks_ecn', 'drops_ecn', 'drops_nonecn', 'packets_ecn', 'packets_nonecn'),
+        params=[bitrate, rtt_l4s, rtt_classic, samples_to_skip],
+        depends=['calc_queue_packets_drops'],
+        outputs=out('aggregated/util_stats', 'aggregated/ecn_over_nonecn_window_ratio'),
+    )
+
+    stages.run(
+        'calc_queuedelay',
+        functools.partial(calc_queuedelay.process_test, testfolder, data=data),
+        code=python_code + [calc_queuedelay.__file__],
+        inputs=ta(*['queue_packets_' + ecn for ecn in ecn_types]),
+        outputs=out('derived/queue_ecn_samplestats', 'derived/queue_nonecn_samplestats'),
+    )
+
+    stages.run(
+        'calc_tagged_rate',
+        functools.partial(calc_tagged_rate.process_test, testfolder, samples_to_skip, data=data),
+        code=python_code + [calc_tagged_rate.__file__],
+        inputs=ta('flows_ecn', 'flows_nonecn', 'flows_rate_ecn', 'flows_rate_nonecn'),
+        params=[samples_to_skip, bitrate, traffic],
+        outputs=out('derived/rate_tagged', 'derived/util_tagged',
+                    'aggregated/rate_tagged_stats', 'aggregated/util_tagged_stats'),
+    )
+
+    stages.run(
+        'calc_utilization',
+        functools.partial(calc_utilization.process_test, testfolder, bitrate, data=data),
+        code=python_code + [calc_utilization.__file__],
+        inputs=ta('rate_ecn', 'rate_nonecn'),
+        params=[bitrate],
+        outputs=out('derived/util'),
+    )
+
+    stages.run(
+        'calc_window',
+        functools.partial(calc_window.process_test, testfolder, rtt_l4s, rtt_classic, data=data),
+        code=python_code + [calc_window.__file__],
+        inputs=ta('rate_ecn', 'rate_nonecn'),
+        params=[rtt_l4s, rtt_classic],
+        depends=['calc_queuedelay'],
+        outputs=out('derived/window'),
+    )
+
+    # only tests with short transfers have completion times
+    fct_files = [file for file, tag in calc_fct.get_fct_files(data)]
+    if len(fct_files) > 0:
+        time_to_skip = samples_to_skip * int(metadata_kv['ta_delay']) / 1000
+        stages.run(
+            'calc_fct',
+            functools.partial(calc_fct.process_test, testfolder, time_to_skip, data=data),
+            code=python_code + [calc_fct.__file__, calc_tagged_rate.__file__],
+            inputs=fct_files,
+            params=[time_to_skip, traffic],
+            outputs=out('aggregated/fct_stats'),
+        )
 
-    calc_queuedelay.process_test(testfolder)
-    calc_tagged_rate.process_test(testfolder, samples_to_skip)
-    calc_utilization.process_test(testfolder, bitrate)
-    calc_window.process_test(testfolder, rtt_l4s, rtt_classic)
+    return samples_to_skip
 
 
 class TestCase:
@@ -116,6 +229,11 @@ class TestCase:
                 return
             else:
                 if not self.testenv.retest:
+                    if self.get_journal_state() in journal.DATA_STATES:
+                        self.h2 = 'Using existing data'
+                        self.already_exists = True
+                        return
+
                     with open(self.test_folder + '/details') as f:
                         for line in f:
                             if line.strip() == 'data_collected':
@@ -132,6 +250,35 @@ class TestCase:
             self.h2 = 'Skipping testcase because environment tells us to'
             self.is_skip_test = True
 
+    def get_journal_state(self):
+        """
+        Get the state of the test in the campaign journal, or
+        None if unknown. See journal.py.
+        """
+        if self.testenv.journal is None:
+            return None
+        return self.testenv.journal.get_state(self.test_folder)
+
+    def record_state(self, state, **args):
+        if self.testenv.journal is not None and not self.testenv.dry_run:
+            self.testenv.journal.record(self.test_folder, state, **args)
+
+    def record_runtime(self):
+        """
+        Record the time used by the test in the journal, see runtime.py
+        """
+        if self.testenv.journal is not None and not self.testenv.dry_run:
+            self.testenv.journal.record_runtime(self.test_folder, runtime.get_history_hints(self.test_folder))
+
+    def get_ta_folders(self):
+        """
+        The folders the analyzers write to, see merge_ta.py
+        """
+        shards = self.testenv.testbed.ta_shards
+        if shards > 1:
+            return [merge_ta.get_shard_folder(self.test_folder, shard) for shard in range(shards)]
+        return [self.test_folder + '/ta']
+
     def run_ta(self, bg=False):
         net_c = re.sub(r'\.[0-9]+$', '.0', os.environ['IP_AQM_C'])
         net_sa = re.sub(r'\.[0-9]+$', '.0', os.environ['IP_AQM_SA'])
@@ -139,21 +286,46 @@ class TestCase:
 
         pcapfilter = 'ip and dst net %s/24 and (src net %s/24 or src net %s/24) and (tcp or udp)' % (net_c, net_sa, net_sb)
 
+        shards = self.testenv.testbed.ta_shards
+        analyzers = []
+        for shard, ta_folder in enumerate(self.get_ta_folders()):
+            shard_filter = pcapfilter
+            taskset = ''
+            if shards > 1:
+                # each analyzer captures the flows with a given sum of ports
+                shard_filter += ' and ((tcp and (tcp[0:2] + tcp[2:2]) %% %d = %d) or (udp and (udp[0:2] + udp[2:2]) %% %d = %d))' % (
+                    shards, shard, shards, shard)
+                taskset = 'taskset -c %d ' % (shard % os.cpu_count())
+
+            analyzers.append("sudo %s%s $IFACE_CLIENTS '%s' '%s' %d %d" % (
+                taskset,
+                os.path.join(os.path.dirname(__file__), 'ta/analyzer'),
+                shard_filter,
+                ta_folder,
+                self.testenv.testbed.ta_delay,
+                self.testenv.testbed.ta_samples + self.testenv.testbed.get_ta_samples_to_skip(),
+            ))
+
+        if shards > 1:
+            run_analyzers = ''.join('%s &\n            pids="$pids $!"\n            ' % analyzer for analyzer in analyzers)
+            # wait for all of them before failing, so no analyzer is left running
+            run_analyzers += 'status=0\n            '
+            run_analyzers += 'for pid in $pids; do wait $pid || status=1; done\n            '
+            run_analyzers += 'exit $status'
+        else:
+            run_analyzers = analyzers[0]
+
         cmd = bash[
             '-c',
             """
             # running analyzer
             set -e
             source aqmt-vars.sh
-            mkdir -p '%s/ta'
-            sudo %s $IFACE_CLIENTS '%s' '%s/ta' %d %d
+            mkdir -p %s
+            %s
             """ % (
-                self.test_folder,
-                os.path.join(os.path.dirname(__file__), 'ta/analyzer'),
-                pcapfilter,
-                self.test_folder,
-                self.testenv.testbed.ta_delay,
-                self.testenv.testbed.ta_samples + self.testenv.testbed.get_ta_samples_to_skip(),
+                ' '.join("'%s'" % ta_folder for ta_folder in self.get_ta_folders()),
+                run_analyzers,
             )
         ]
 
@@ -169,16 +341,55 @@ class TestCase:
         return pid
 
     def calc_post_wait_time(self):
-        """The time it will idle after the test is run"""
+        """
+        The time it will idle after the test is run, or with
+        adaptive cooldown the maximum time to wait for the
+        testbed to become idle
+        """
         return max(self.testenv.testbed.rtt_clients, self.testenv.testbed.rtt_servera, self.testenv.testbed.rtt_serverb) / 1000 * 5 + 2
 
-    def calc_estimated_run_time(self):
+    def calc_estimated_run_time(self, test_fn=None, include_analysis=False):
+        """
+        Estimate the time based on the time used by earlier tests,
+        see runtime.py.
+
+        Without any history we add one second for various delay.
+        Note the time then excludes any time used in pre/post hooks as it is unknown.
+        """
+        testbed = self.testenv.testbed
+        collect_time = runtime.get_collect_time(testbed.ta_samples, testbed.get_ta_samples_to_skip(), testbed.ta_delay)
+
+        history = self.testenv.runtime_history
+        if history is None or history.num_tests == 0:
+            return collect_time + self.calc_post_wait_time() + 1
+
+        features = runtime.get_features(
+            get_name(test_fn),
+            testbed.aqm_name,
+            testbed.bitrate,
+            max(testbed.rtt_clients, testbed.rtt_servera, testbed.rtt_serverb),
+        )
+        return history.estimate(features, collect_time, self.calc_post_wait_time(), include_analysis,
+                                fixed_cooldown=not self.testenv.adaptive_cooldown)
+
+    @contextmanager
+    def span(self, name, save_duration=False):
         """
-        Add one second for various delay.
-        Note the time excludes any time used in pre/post hooks as it is unknown.
+        Record the time of a phase of the test in the timeline
+
+        save_duration: Also store the time in the details file,
+          used to estimate the time of later tests
         """
-        samples = self.testenv.testbed.ta_samples + self.testenv.testbed.get_ta_samples_to_skip()
-        return samples * self.testenv.testbed.ta_delay / 1000 + self.calc_post_wait_time() + 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+
+            if not self.testenv.dry_run:
+                timeline.add_span(self.test_folder, name, 'test', start, end, test=self.test_folder)
+                if save_duration:
+                    runtime.save_duration(self.test_folder, name, end - start)
 
     def run(self, test_fn, pre_hook=None, post_hook=None):
         if self.directory_error:
@@ -192,49 +403,84 @@ class TestCase:
             os.makedirs(self.test_folder, exist_ok=True)
 
         start = time.time()
+        self.record_state(journal.RUNNING)
         self.save_hint('type test')
-
-        if not self.testenv.testbed.reset(dry_run=self.testenv.dry_run):
-            raise Exception('Reset failed')
+        self.save_hint('test_fn %s' % get_name(test_fn))
+
+        if self.testenv.ssh_pool is not None and not self.testenv.dry_run:
+            with self.span('ssh_check'):
+                if not self.testenv.ssh_pool.check():
+                    raise TestbedError('Lost SSH connection to testbed')
+
+        # ports in use might have changed since the previous test
+        self.testenv.testbed.clear_ports_in_use()
+
+        reuse = self.testenv.reuse_setup
+        with self.span('reset', save_duration=True):
+            if not self.testenv.testbed.reset(dry_run=self.testenv.dry_run, keep_setup=reuse):
+                raise TestbedError('Reset failed')
+            if self.testenv.adaptive_cooldown:
+                with self.span('wait_idle'):
+                    self.testenv.testbed.wait_until_idle(dry_run=self.testenv.dry_run, timeout=self.calc_post_wait_time())
         logger.info('%.2f s: Testbed reset' % (time.time()-start))
 
-        if not self.testenv.testbed.setup(dry_run=self.testenv.dry_run):
-            raise Exception('Setup failed')
-        if not self.testenv.dry_run:
-            logger.info(self.testenv.testbed.get_setup())
+        with self.span('setup', save_duration=True):
+            if not self.testenv.testbed.setup(dry_run=self.testenv.dry_run, reuse=reuse):
+                raise TestbedError('Setup failed')
+            if not self.testenv.dry_run:
+                with self.span('get_setup'):
+                    logger.info(self.testenv.testbed.get_setup())
 
-        if pre_hook is not None and not self.testenv.dry_run:
-            pre_hook(self)
+        with self.span('pre_hook', save_duration=True):
+            if pre_hook is not None and not self.testenv.dry_run:
+                pre_hook(self)
 
-        logger.info('%.2f s: Testbed initialized, starting test. Estimated time to finish: %d s' % (time.time()-start, self.calc_estimated_run_time()))
+        logger.info('%.2f s: Testbed initialized, starting test. Estimated time to finish: %d s' % (time.time()-start, self.calc_estimated_run_time(test_fn)))
 
         self.save_hint('ta_idle %s' % self.testenv.testbed.ta_idle)
         self.save_hint('ta_delay %s' % self.testenv.testbed.ta_delay)
         self.save_hint('ta_samples %s' % self.testenv.testbed.ta_samples)
         self.save_hint('ta_samples_pre %s' % self.testenv.testbed.get_ta_samples_to_skip())
+        if self.testenv.testbed.ta_shards > 1:
+            self.save_hint('ta_shards %s' % self.testenv.testbed.ta_shards)
 
         hint = self.testenv.testbed.get_hint(dry_run=self.testenv.dry_run)
         for line in hint.split('\n'):
             self.save_hint(line)
 
-        set_pid_ta(self.run_ta(bg=not self.testenv.is_interactive))
+        with self.span('collect', save_duration=True):
+            with self.span('start_analyzer'):
+                set_pid_ta(self.run_ta(bg=not self.testenv.is_interactive))
 
-        if self.testenv.is_interactive and not self.testenv.dry_run:
-            self.testenv.run_monitor_setup()
-            self.testenv.run_speedometer(self.testenv.testbed.bitrate * 1.1, delay=0.05)
+            if self.testenv.is_interactive and not self.testenv.dry_run:
+                self.testenv.run_monitor_setup()
+                self.testenv.run_speedometer(self.testenv.testbed.bitrate * 1.1, delay=0.05)
 
-        test_fn(self)
+            with self.span('start_traffic'):
+                set_test_folder(self.test_folder)
+                test_fn(self)
 
-        if not self.testenv.dry_run:
-            processes.waitpid(get_pid_ta())  # wait until 'ta' quits
-        set_pid_ta(None)
+            with self.span('wait_analyzer'):
+                if not self.testenv.dry_run:
+                    if self.testenv.early_stop is not None:
+                        self.wait_for_convergence(get_pid_ta())
+                    processes.waitpid(get_pid_ta())  # wait until 'ta' quits
+            set_pid_ta(None)
+            set_test_folder(None)
+
+            if self.testenv.testbed.ta_shards > 1 and not self.testenv.dry_run:
+                with self.span('merge_ta'):
+                    merge_ta.process_test(self.test_folder)
 
         logger.info('%.2f s: Data collection finished' % (time.time()-start))
 
-        if post_hook is not None and not self.testenv.dry_run:
-            post_hook(self)
+        with self.span('post_hook', save_duration=True):
+            if post_hook is not None and not self.testenv.dry_run:
+                post_hook(self)
 
-        processes.kill_known_pids()
+        with self.span('kill_processes'):
+            close_agents()
+            processes.kill_known_pids()
 
         if processes.is_exiting:
             print("You have aborted an active test")
@@ -245,19 +491,58 @@ class TestCase:
 
         self.save_hint('data_collected')
         self.data_collected = True
-
-        if not self.testenv.testbed.reset(dry_run=self.testenv.dry_run):
-            raise Exception('Reset failed')
-        logger.info('%.2f s: Testbed reset, waiting %.2f s for cooldown period' % (time.time()-start, self.calc_post_wait_time()))
+        self.record_state(journal.COLLECTED, duration=time.time()-start)
+
+        # the configuration is kept for the next test unless we are aborting,
+        # the AQM is recreated by the next setup so its queue is emptied
+        keep_setup = reuse and not processes.is_exiting
+        with self.span('reset_post', save_duration=True):
+            if not self.testenv.testbed.reset(dry_run=self.testenv.dry_run, keep_setup=keep_setup):
+                raise TestbedError('Reset failed')
+        if self.testenv.adaptive_cooldown:
+            logger.info('%.2f s: Testbed reset, waiting up to %.2f s for the testbed to be idle' % (time.time()-start, self.calc_post_wait_time()))
+        else:
+            logger.info('%.2f s: Testbed reset, waiting %.2f s for cooldown period' % (time.time()-start, self.calc_post_wait_time()))
 
         # in case there is a a queue buildup it should now free because the
-        # testbed is reset (so no added RTT or rate limit) and we give it some
-        # time to complete
-        time.sleep(self.calc_post_wait_time())
+        # traffic is stopped (and unless the setup is kept, the testbed is reset
+        # so no added RTT or rate limit) and we give it some time to complete
+        with self.span('cooldown', save_duration=True):
+            if self.testenv.adaptive_cooldown:
+                self.testenv.testbed.wait_until_idle(dry_run=self.testenv.dry_run, timeout=self.calc_post_wait_time())
+            else:
+                time.sleep(self.calc_post_wait_time())
         logger.info('%.2f s: Finished waiting to let the connections finish' % (time.time()-start))
 
         self.testenv.get_terminal().cleanup()
 
+    def wait_for_convergence(self, pid_ta):
+        """
+        Stop the analyzer when the results have converged, or
+        return when it stops by itself. See convergence.py.
+        """
+        testbed = self.testenv.testbed
+        monitor = ConvergenceMonitor(self.get_ta_folders(), testbed.get_ta_samples_to_skip(), self.testenv.early_stop)
+        min_samples = testbed.get_ta_samples_to_skip() + math.ceil(self.testenv.early_stop_min_time * 1000 / testbed.ta_delay)
+
+        while len(processes.wait_pids([pid_ta], timeout=testbed.ta_delay / 1000, include_group=True)) > 0:
+            monitor.read()
+            if monitor.get_num_samples() >= min_samples and monitor.is_converged():
+                logger.info('Results converged after %d samples, stopping the test' % monitor.get_num_samples())
+                self.save_hint('early_stop %d' % monitor.get_num_samples())
+                processes.kill_pid(pid_ta)
+                return
+
+    def abort(self):
+        """
+        Stop what is left of a test that failed while running
+        """
+        set_pid_ta(None)
+        set_test_folder(None)
+        close_agents()
+        processes.kill_known_pids()
+        self.testenv.get_terminal().cleanup()
+
     def should_skip(self):
         return self.directory_error or self.data_collected or self.already_exists or self.is_skip_test
 
@@ -265,6 +550,10 @@ class TestCase:
         return self.already_exists or (not self.testenv.dry_run and self.data_collected)
 
     def already_analyzed(self):
+        state = self.get_journal_state()
+        if state in journal.DATA_STATES:
+            return state != journal.COLLECTED
+
         if not os.path.isfile(self.test_folder + '/details'):
             return False
 
@@ -276,12 +565,16 @@ class TestCase:
         return False
 
 
-    def analyze(self, analyze_fn):
-        samples_to_skip = self.testenv.testbed.get_ta_samples_to_skip()
+    def analyze(self, analyze_fn, samples_to_skip=None):
+        if samples_to_skip is None:
+            samples_to_skip = self.testenv.testbed.get_ta_samples_to_skip()
 
         remove_hint(self.test_folder, ['data_analyzed', 'analyzed_aggregated_samples_skipped'])
 
-        analyze_fn(self, samples_to_skip)
+        # the analysis might decide the samples to skip itself
+        samples_skipped = analyze_fn(self, samples_to_skip)
+        if samples_skipped is not None:
+            samples_to_skip = samples_skipped
 
         self.save_hint('data_analyzed')
         self.save_hint('analyzed_aggregated_samples_skipped %d' % samples_to_skip)
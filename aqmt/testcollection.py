@@ -2,17 +2,27 @@
 This module contains the test collection logic
 """
 
+import functools
 import html
 import os
 import time
 import sys
 
+from . import journal
 from . import logger
 from . import processes
+from . import timeline
+from .testbed import TestbedError
 from .testcase import TestCase
+from .testplan import get_plan_cost, get_state, set_state
 from .testenv import remove_hint, save_hint_to_folder
 
 
+def log_analysis_error(test_folder, future):
+    if future.exception() is not None:
+        logger.error('Analyzing/plotting test %s failed: %s' % (test_folder, future.exception()))
+
+
 def build_html_index(tree, root_folder):
     def get_innerfolder(subfolder):
         if subfolder[0:len(root_folder)] == root_folder:
@@ -114,7 +124,12 @@ class TestCollection:
     - collection of collections, and so on
     """
 
-    def __init__(self, folder, title=None, subtitle=None, titlelabel=None, parent=None):
+    def __init__(self, folder, title=None, subtitle=None, titlelabel=None, parent=None, hints=None, dynamic=False):
+        """
+        dynamic: The branches of the step depend on the results of earlier
+          tests, so the branches of the dry run are only placeholders
+          (see steps.branch_search)
+        """
         if parent:
             self.folder = parent.folder + '/' + folder
             parent.check_and_add_tag(folder)
@@ -124,15 +139,29 @@ class TestCollection:
         self.tags_used = []  # to make sure we have unique tags as children
 
         self.test = None
+        self.planned_test = None
         self.collections = []
+        self.children_with_data = set()
+        self.pending_tests = []  # planned tests not yet run in this subtree
+        self.pending_analysis = []  # futures of tests analyzed in background in this subtree
 
         self.parent = parent
         self.parent_called = False
 
+        # folder of the collection having dynamic branches at or above
+        # this collection, or None. The tests below it are left out of
+        # the plan file and the journal of the dry run.
+        self.dynamic_parent = None
+        if parent is not None:
+            self.dynamic_parent = parent.dynamic_parent
+            if self.dynamic_parent is None and dynamic:
+                self.dynamic_parent = parent.folder
+
         self.hints_initialized = False  # defer initialization of hints till we have data
         self.title = title
         self.subtitle = subtitle
         self.titlelabel = titlelabel
+        self.hints = hints if hints is not None else []  # additional hints to save
 
     def check_and_add_tag(self, tag):
         """
@@ -168,13 +197,42 @@ class TestCollection:
             if self.titlelabel is not None:
                 save_hint_to_folder(self.folder, 'titlelabel %s' % self.titlelabel)
 
-        save_hint_to_folder(self.folder, 'sub %s' % child_folder)
+            for hint in self.hints:
+                save_hint_to_folder(self.folder, hint)
+
+        self.children_with_data.add(child_folder)
+        self.save_sub_hints()
 
         if self.parent and not self.parent_called:
             self.parent_called = True
             self.parent.collections.append(self)
             self.parent.add_child(os.path.basename(self.folder))
 
+    def save_sub_hints(self):
+        """
+        Save the children with data in the order of their tags
+
+        The children might not get data in the order they were
+        defined if the tests are reordered, so keep the order
+        the tags were added.
+        """
+        remove_hint(self.folder, ['sub'])
+        for tag in self.tags_used + ['test']:
+            if tag in self.children_with_data:
+                save_hint_to_folder(self.folder, 'sub %s' % tag)
+
+    def sort_children(self, key):
+        """
+        Change the order of the children, used by steps that
+        don't create the branches in the order they should be
+        plotted (see steps.branch_search)
+
+        key: Function receiving a tag returning the value to sort by
+        """
+        self.tags_used.sort(key=key)
+        if self.hints_initialized:
+            self.save_sub_hints()
+
     def run_test(self, test_fn, testenv, analyze_fn, plot_fn,
             pre_hook=None, post_hook=None):
         """
@@ -202,25 +260,61 @@ class TestCollection:
         if not self.test.should_skip():
             self.test.log_header()
             logged_header = True
-            self.test.run(test_fn, pre_hook=pre_hook, post_hook=post_hook)
+            start = time.time()
+            self.run_with_retries(test_fn, testenv, pre_hook, post_hook)
+            timeline.add_span(self.test.test_folder, 'test', 'test', start, time.time(), test=self.test.test_folder)
 
         if (self.test.data_collected or self.test.already_exists) and not testenv.dry_run:
             if not logged_header:
                 self.test.log_header()
                 logged_header = True
 
-            if testenv.reanalyze or not self.test.already_analyzed():
-                start = time.time()
-                self.test.analyze(analyze_fn)
-                logger.info('Analyzed test (%.2f s)' % (time.time()-start))
+            should_analyze = testenv.reanalyze or not self.test.already_analyzed()
+            # tests in the journal might have stopped before they were plotted
+            journal_state = self.test.get_journal_state()
+            should_plot = testenv.reanalyze or testenv.replot or not self.test.already_exists or \
+                (journal_state is not None and journal_state != journal.PLOTTED)
+
+            # resolve this now as the testbed will be changed by
+            # the next test if we analyze in the background
+            samples_to_skip = testenv.testbed.get_ta_samples_to_skip()
+
+            def analyze_and_plot(testcase):
+                if should_analyze:
+                    start = time.time()
+                    with testcase.span('analyze', save_duration=True):
+                        testcase.analyze(analyze_fn, samples_to_skip)
+                    testcase.record_state(journal.ANALYZED)
+                    logger.info('Analyzed test %s (%.2f s)' % (testcase.test_folder, time.time()-start))
+
+                if should_plot:
+                    start = time.time()
+                    with testcase.span('plot', save_duration=True):
+                        plot_fn(testcase)
+                    testcase.record_state(journal.PLOTTED)
+                    logger.info('Plotted test %s (%.2f s)' % (testcase.test_folder, time.time()-start))
+
+                if should_analyze or should_plot or testcase.data_collected:
+                    testcase.record_runtime()
+
+            if testenv.analysis_workers > 0:
+                future = testenv.get_analysis_pool().submit(analyze_and_plot, self.test)
+                future.add_done_callback(functools.partial(log_analysis_error, self.test.test_folder))
+
+                collection = self
+                while collection is not None:
+                    collection.pending_analysis.append(future)
+                    collection = collection.parent
 
-            if testenv.reanalyze or testenv.replot or not self.test.already_exists:
-                start = time.time()
-                plot_fn(self.test)
-                logger.info('Plotted test (%.2f s)' % (time.time()-start))
+            else:
+                analyze_and_plot(self.test)
 
             self.add_child(test_folder)
 
+            # only tests run now are in the estimate
+            if testenv.progress is not None and self.test.data_collected:
+                testenv.progress.test_finished(self.test.test_folder)
+
         elif self.test.already_exists:
             if not logged_header:
                 self.test.log_header()
@@ -230,17 +324,109 @@ class TestCollection:
 
         # if we have received a SIGTERM we will terminate TA but allow the plotting
         if processes.is_exiting:
+            self.wait_for_analysis()
             processes.kill_known_pids()
             testenv.get_terminal().cleanup()
             sys.exit()
 
-    def get_metadata(self, testenv):
+    def run_with_retries(self, test_fn, testenv, pre_hook=None, post_hook=None):
+        """
+        Run the test, and retry it if the testbed fails, e.g. if the
+        setup of the testbed fails. The wait before each retry is doubled.
+        Other errors, e.g. in the test function or hooks, are not retried.
+        """
+        attempt = 0
+        while True:
+            try:
+                self.test.run(test_fn, pre_hook=pre_hook, post_hook=post_hook)
+                return
+            except Exception as e:
+                if self.test.data_collected:
+                    raise  # the data is kept
+
+                self.test.record_state(journal.FAILED, reason=str(e), attempt=attempt + 1)
+                if not isinstance(e, TestbedError) or attempt >= testenv.retries or \
+                        testenv.dry_run or processes.is_exiting:
+                    raise
+
+                delay = testenv.retry_delay * 2 ** attempt
+                logger.error('Test %s failed: %s. Retrying in %d s' % (self.test.test_folder, e, delay))
+                self.test.abort()
+                time.sleep(delay)
+
+                attempt += 1
+                self.test = TestCase(testenv=testenv, folder=self.test.test_folder)
+
+    def plan_test(self, planned_test):
+        """
+        Add a test to be run later by run_pending_tests() instead
+        of running it right away
+        """
+        if self.test or self.planned_test:
+            raise Exception("A collection cannot contain multiple tests")
+
+        self.planned_test = planned_test
+
+        # the test was not in the plan of the dry run
+        if self.dynamic_parent is not None and planned_test.will_test:
+            testenv = planned_test.run_args['testenv']
+            testenv.journal.record(self.folder + '/test', journal.QUEUED)
+
+        collection = self
+        while collection is not None:
+            collection.pending_tests.append(planned_test)
+            collection = collection.parent
+
+    def run_pending_tests(self):
+        """
+        Run the planned tests in this collection and below, in
+        the order given by the scheduler
+        """
+        pending = [test for test in self.pending_tests if not test.done]
+        self.pending_tests = []
+
+        if len(pending) == 0 or processes.is_exiting:
+            return
+
+        testenv = pending[0].run_args['testenv']
+        applied_config = testenv.testbed.get_applied_config()
+        ordered = testenv.scheduler(pending, applied_config)
+
+        logger.info('Running %d tests in %s (reconfiguration cost %d, %d in order of steps)' % (
+            len(ordered), self.folder, get_plan_cost(ordered, applied_config), get_plan_cost(pending, applied_config)))
+
+        # the steps continue from the state they had before the tests
+        state = get_state(testenv)
+        for test in ordered:
+            test.run(testenv)
+        set_state(testenv, state)
+
+    def wait_for_analysis(self):
+        """
+        Wait until all tests in this collection and below are run,
+        and the ones analyzed and plotted in the background have finished
+
+        Must be called before using the results of the tests, e.g.
+        in a step plotting the collection.
+        """
+        self.run_pending_tests()
+
+        pending = self.pending_analysis
+        self.pending_analysis = []
+
+        for future in pending:
+            future.result()
+
+    def get_metadata(self, testenv, test_fn=None):
         """
         Instead of running the test, this method can be called
         to generate various metedata without actually running the test.
+
+        The estimated time includes analyzing and plotting the test
+        unless it is done in the background.
         """
         test = TestCase(testenv=testenv, folder=self.folder + '/test')
         return {
-            'estimated_time': test.calc_estimated_run_time(),
+            'estimated_time': test.calc_estimated_run_time(test_fn, include_analysis=testenv.analysis_workers == 0),
             'will_test': not test.should_skip(),
         }
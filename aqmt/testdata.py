@@ -0,0 +1,211 @@
+"""
+This module contains the in-memory representation of the data
+in a test folder, used while analyzing a test
+
+Each file written by the analyzer is only read and parsed once,
+and the parsed arrays are shared by all analysis stages. Stages
+can also store per sample results in `derived`, so later stages
+don't have to read them back from disk.
+
+The first time a table in the ta folder is parsed it is also stored
+as binary .npy files in ta/npy, which are memory mapped on later
+reads instead of parsing the text again. The histograms in the
+queue_packets_ecnXX and queue_drops_ecnXX files are mostly empty,
+so only their nonzero cells are stored.
+"""
+
+import numpy as np
+import os
+
+from . import logger
+from .testenv import read_metadata
+
+SIDECAR_FOLDER = 'npy'
+
+
+def parse_table(text, name='table', n_columns=None):
+    """
+    Parse a table of space separated integers into a 2-D array
+
+    Comment lines (starting with #) are ignored. All lines are
+    expected to have the same number of columns. An incomplete last
+    line (e.g. from an aborted test) is ignored.
+
+    n_columns: The number of columns of the table, if known. Used for
+      a table without any lines (e.g. from a test aborted before the
+      first sample), which otherwise is an error as the number of
+      columns is given by the first line.
+    """
+    if text.startswith('#') or '\n#' in text:
+        text = ''.join(line for line in text.splitlines(True) if not line.startswith('#'))
+
+    first_line = text.split('\n', 1)[0]
+    if first_line.strip() == '':
+        if n_columns is None:
+            raise Exception('No rows in %s' % name)
+        return np.zeros((0, n_columns), dtype=int)
+
+    n_columns = len(first_line.split())
+
+    numbers = np.fromstring(text, dtype=int, sep=' ')
+    numbers = numbers[:numbers.size - numbers.size % n_columns]
+    return numbers.reshape(-1, n_columns)
+
+
+def encode_sparse(counts):
+    """
+    Encode a 2-D array as a list of (row, column, value) for nonzero cells
+    """
+    rows, cols = np.nonzero(counts)
+    return np.column_stack((rows, cols, counts[rows, cols]))
+
+
+def decode_sparse(sparse, shape):
+    counts = np.zeros(shape, dtype=int)
+    counts[sparse[:, 0], sparse[:, 1]] = sparse[:, 2]
+    return counts
+
+
+class TestData:
+    def __init__(self, folder, use_sidecar=True):
+        self.folder = folder
+        self.use_sidecar = use_sidecar
+        self.derived = {}  # per sample results shared between stages
+
+        self._details = None
+        self._tables = {}
+        self._histograms = {}
+        self._flows = {}
+
+    def get_details(self):
+        """
+        Returns the same as read_metadata() for the details file
+        """
+        if self._details is None:
+            self._details = read_metadata(self.folder + '/details')
+        return self._details
+
+    def get_sidecar_file(self, name, part):
+        return '%s/ta/%s/%s.%s.npy' % (self.folder, SIDECAR_FOLDER, name, part)
+
+    def load_sidecar(self, name, parts):
+        """
+        Load the sidecar arrays of a file in the ta folder
+
+        Returns None if the sidecar is missing or older than the file.
+        """
+        if not self.use_sidecar:
+            return None
+
+        source = self.folder + '/ta/' + name
+        files = [self.get_sidecar_file(name, part) for part in parts]
+
+        if not all(os.path.isfile(file) for file in files):
+            return None
+
+        if os.path.isfile(source) and \
+                any(os.path.getmtime(file) < os.path.getmtime(source) for file in files):
+            return None
+
+        return [np.load(file, mmap_mode='r') for file in files]
+
+    def save_sidecar(self, name, arrays):
+        """
+        Store the arrays of a file in the ta folder as sidecar files
+
+        The files are written to a temporary name and moved in
+        place so a concurrent reader never sees a partial file.
+        """
+        if not self.use_sidecar:
+            return
+
+        try:
+            os.makedirs('%s/ta/%s' % (self.folder, SIDECAR_FOLDER), exist_ok=True)
+            for part, array in arrays.items():
+                file = self.get_sidecar_file(name, part)
+                tmpfile = '%s.%d.tmp' % (file, os.getpid())
+                with open(tmpfile, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmpfile, file)
+        except OSError as e:
+            logger.warn('Could not store sidecar for %s/ta/%s: %s' % (self.folder, name, e))
+
+    def get_num_columns(self, name):
+        """
+        The number of columns of a table in the ta folder,
+        or None if unknown
+        """
+        if name.startswith('packets_'):
+            return 1  # <value>
+        if name.startswith('flows_'):
+            # <sample id> <time> <value for each flow>
+            return 2 + len(self.get_flows(name.rsplit('_', 1)[1]))
+        if name.split('_')[0] in ['rate', 'drops', 'marks']:
+            return 3  # <sample id> <time> <value>
+        return None
+
+    def get_table(self, name):
+        """
+        Get a file in the ta folder as a 2-D array of integers,
+        e.g. rate_ecn or flows_rate_nonecn
+        """
+        if name not in self._tables:
+            sidecar = self.load_sidecar(name, ['table'])
+            if sidecar is not None:
+                self._tables[name] = sidecar[0]
+            else:
+                with open(self.folder + '/ta/' + name, 'r') as f:
+                    self._tables[name] = parse_table(f.read(), self.folder + '/ta/' + name, self.get_num_columns(name))
+                self.save_sidecar(name, {'table': self._tables[name]})
+        return self._tables[name]
+
+    def get_histograms(self, name):
+        """
+        Get one of the queue_packets_ecnXX or queue_drops_ecnXX
+        files in the ta folder
+
+        Returns a tuple containing:
+        - the queueing delay in us that each column represents
+        - the time of each sample
+        - 2-D array of counts with one row per sample
+        """
+        if name not in self._histograms:
+            sidecar = self.load_sidecar(name, ['header', 'times', 'sparse'])
+            if sidecar is not None:
+                header_us, times, sparse = sidecar
+                counts = decode_sparse(sparse, (times.size, header_us.size))
+
+            else:
+                with open(self.folder + '/ta/' + name, 'r') as f:
+                    # the first column in the header contains number of
+                    # columns following, which we ignore
+                    header_us = np.fromstring(f.readline(), dtype=int, sep=' ')[1:]
+                    numbers = np.fromstring(f.read(), dtype=int, sep=' ')
+
+                # ignore an incomplete last line, as in parse_table
+                n_columns = header_us.size + 1
+                numbers = numbers[:numbers.size - numbers.size % n_columns]
+                numbers = numbers.reshape(-1, n_columns)
+                times = numbers[:, 0]
+                counts = numbers[:, 1:]
+
+                self.save_sidecar(name, {
+                    'header': header_us,
+                    'times': times,
+                    'sparse': encode_sparse(counts),
+                })
+
+            self._histograms[name] = (header_us, times, counts)
+        return self._histograms[name]
+
+    def get_flows(self, ecntype):
+        """
+        Get the list of flows in the ecn or nonecn queue, in the
+        same order as the columns in flows_rate_*
+
+        Each flow is a line like: TCP 10.25.2.21 5504 10.25.1.11 53898
+        """
+        if ecntype not in self._flows:
+            with open(self.folder + '/ta/flows_' + ecntype, 'r') as f:
+                self._flows[ecntype] = [line.strip() for line in f]
+        return self._flows[ecntype]
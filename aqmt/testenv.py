@@ -5,6 +5,7 @@ It does not include the testbed configuration, but things
 around the testbed for running the actual tests.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import os
 from plumbum import local
 import signal
@@ -12,9 +13,11 @@ import sys
 
 from . import logger
 from . import processes
+from .ssh import SshPool
 from .terminal import Terminal, Tmux, get_log_cmd
 
 pid_ta = None
+test_folder = None
 
 
 def get_pid_ta():
@@ -26,6 +29,19 @@ def set_pid_ta(new_pid):
     pid_ta = new_pid
 
 
+def get_test_folder():
+    """
+    The folder of the test collecting data, for traffic
+    generators storing their own results
+    """
+    return test_folder
+
+
+def set_test_folder(folder):
+    global test_folder
+    test_folder = folder
+
+
 def remove_hint(folder, hint_names=None):
     if hint_names is None:
         hint_names = []
@@ -75,14 +91,65 @@ def read_metadata(file):
 
 
 class TestEnv:
-    def __init__(self, testbed, is_interactive=None, dry_run=False, reanalyze=False, replot=False, retest=False, skip_test=False):
+    def __init__(self, testbed, is_interactive=None, dry_run=False, reanalyze=False, replot=False, retest=False, skip_test=False,
+            analysis_workers=0, reuse_setup=False, scheduler=None, history_folders=None,
+            keep_ssh_connections=False, adaptive_cooldown=False, detect_steady_state=False,
+            early_stop=None, early_stop_min_time=60, retries=0, retry_delay=10):
         """
         skip_test: Will skip the test as if it already exists
+        analysis_workers: If above 0, tests are analyzed and plotted by this
+          number of background workers while the next test runs. Note that
+          this uses CPU on the AQM machine, which also captures the traffic.
+        reuse_setup: Keep the testbed configured between tests and only
+          reapply the parts of the configuration that change. Do not use
+          this if a hook or test changes the testbed in a way the Testbed
+          object does not know about.
+        scheduler: Function deciding the order the tests are run in, e.g.
+          aqmt.testplan.schedule_min_reconfiguration. See testplan.py. By
+          default the tests are run right away in the order of the steps.
+        history_folders: Folders with earlier results used to estimate the
+          time of the tests, in addition to the folder of the tests being
+          run. See runtime.py.
+        keep_ssh_connections: Keep one SSH connection open to each of the
+          clients and servers while running the tests. See ssh.py.
+        adaptive_cooldown: Wait until the queues on the AQM node are empty
+          and no traffic passes before and after each test, instead of
+          waiting a fixed time after the test. The fixed time is then
+          used as a timeout.
+        detect_steady_state: Skip the samples detected as warm-up when
+          aggregating the results, instead of the fixed number of samples
+          given by the testbed. See calc_steady_state.py.
+        early_stop: Stop the data collection when the confidence intervals
+          of the utilization and queueing delay are within this tolerance
+          relative to their value, e.g. 0.05. The number of samples given
+          by the testbed is then the maximum. See convergence.py.
+        early_stop_min_time: Minimum time in seconds to collect data after
+          the warm-up when using early_stop.
+        retries: Number of times to retry a test if the testbed fails,
+          e.g. if the setup of the testbed fails or the connection to a
+          node is lost. See TestbedError in testbed.py.
+        retry_delay: Seconds to wait before the first retry of a test,
+          doubled for each retry.
         """
         self.testbed = testbed
 
         self.tests = []  # list of tests that has been run
         self.terminal = None
+        self.analysis_workers = analysis_workers
+        self.analysis_pool = None
+        self.reuse_setup = reuse_setup
+        self.adaptive_cooldown = adaptive_cooldown
+        self.detect_steady_state = detect_steady_state
+        self.early_stop = early_stop
+        self.early_stop_min_time = early_stop_min_time
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.scheduler = scheduler
+        self.history_folders = history_folders if history_folders is not None else []
+        self.runtime_history = None  # set by run_test
+        self.progress = None  # set by run_test
+        self.journal = None  # set by run_test
+        self.ssh_pool = SshPool() if keep_ssh_connections else None
 
         if is_interactive is None:
             is_interactive = 'TEST_INTERACTIVE' in os.environ and os.environ['TEST_INTERACTIVE']  # run in tmux or not
@@ -107,6 +174,11 @@ class TestEnv:
         signal.signal(signal.SIGINT, exit_gracefully)
         signal.signal(signal.SIGTERM, exit_gracefully)
 
+    def get_analysis_pool(self):
+        if self.analysis_pool is None:
+            self.analysis_pool = ThreadPoolExecutor(max_workers=self.analysis_workers)
+        return self.analysis_pool
+
     def get_terminal(self):
         if self.terminal is None:
             self.terminal = Tmux() if self.is_interactive else Terminal()
@@ -0,0 +1,192 @@
+"""
+This module contains the test plan logic
+
+When walking the steps, each test is recorded as a PlannedTest holding
+a copy of the testbed and the other state the steps have set up for
+it. This makes it possible to run the tests in a different order than
+the steps define, e.g. to minimize the number of times the testbed has
+to be reconfigured.
+
+The tests are run when the results are needed, i.e. when a step calls
+testdef.collection.wait_for_analysis(), so a scheduler can only reorder
+the tests below the same collection being plotted. The folder hierarchy
+and the hints in the details files are the same as when running the
+tests in the order of the steps.
+
+A scheduler is a function taking a list of PlannedTest and the
+configuration currently applied to the testbed (or None), returning
+the list in the order the tests should be run.
+
+The plan is also stored as plan.json in the result folder. This file
+only describes the tests (folder, names of the test function and hooks,
+and the testbed parameters) so it can be inspected or compared with a
+later run. It cannot be loaded and run, as the test functions, hooks
+and state of the steps are not serializable. The tests are always run
+by walking the steps again, which gives the same plan.
+"""
+
+import copy
+import hashlib
+import json
+
+from .testbed import Testbed
+
+# attributes of Testdef that refer to objects shared by all tests
+TESTDEF_SHARED_ATTRS = ['collection', 'testbed', 'testenv']
+
+# attributes of TestEnv that steps might change for a test
+TESTENV_ATTRS = ['skip_test', 'reanalyze', 'replot', 'retest']
+
+# attributes of Testbed stored in the plan file
+TESTBED_PLAN_ATTRS = [
+    'bitrate', 'rtt_clients', 'rtt_servera', 'rtt_serverb',
+    'netem_clients_params', 'netem_servera_params', 'netem_serverb_params',
+    'aqm_name', 'aqm_params', 'cc_a', 'ecn_a', 'cc_b', 'ecn_b',
+    'ta_delay', 'ip_classification', 'ta_samples', 'ta_idle', 'ta_shards',
+    'traffic_port',
+]
+
+
+def get_state(testenv):
+    """
+    Get a copy of the state the steps have set up for the next test
+    """
+    testdef_vars = {
+        key: copy.copy(value)
+        for key, value in vars(testenv.testdef).items()
+        if key not in TESTDEF_SHARED_ATTRS
+    }
+
+    return {
+        'testbed': copy.deepcopy(testenv.testbed),
+        'testdef': testdef_vars,
+        'testenv': {attr: getattr(testenv, attr) for attr in TESTENV_ATTRS},
+    }
+
+
+def set_state(testenv, state):
+    """
+    Restore a state from get_state()
+
+    The testbed object is updated in place as it is shared, except
+    the traffic port which should keep increasing between tests.
+    """
+    testbed_vars = dict(vars(state['testbed']))
+    testbed_vars['traffic_port'] = testenv.testbed.traffic_port
+    vars(testenv.testbed).update(copy.deepcopy(testbed_vars))
+
+    vars(testenv.testdef).update(state['testdef'])
+
+    for attr, value in state['testenv'].items():
+        setattr(testenv, attr, value)
+
+
+def get_name(fn):
+    if fn is None:
+        return None
+    return getattr(fn, '__qualname__', repr(fn))
+
+
+class PlannedTest:
+    def __init__(self, collection, run_args, state, estimated_time=0, will_test=True):
+        """
+        collection: The TestCollection that will contain the test
+        run_args: Arguments to TestCollection.run_test()
+        state: The state from get_state()
+        """
+        self.collection = collection
+        self.run_args = run_args
+        self.state = state
+        self.estimated_time = estimated_time
+        self.will_test = will_test
+        self.config = state['testbed'].get_config()
+        self.done = False
+
+    def is_dynamic(self):
+        """
+        If the test is below a dynamic branch, so the test of the dry run
+        is a placeholder and the test run might be in another folder
+        """
+        return self.collection.dynamic_parent is not None
+
+    def run(self, testenv):
+        set_state(testenv, self.state)
+        self.done = True
+        self.collection.run_test(**self.run_args)
+
+    def to_dict(self):
+        return {
+            'folder': self.collection.folder + '/test',
+            'test_fn': get_name(self.run_args['test_fn']),
+            'pre_hook': get_name(self.run_args.get('pre_hook')),
+            'post_hook': get_name(self.run_args.get('post_hook')),
+            'testbed': {attr: getattr(self.state['testbed'], attr) for attr in TESTBED_PLAN_ATTRS},
+            'config_hash': self.state['testbed'].get_config_hash(),
+            'estimated_time': self.estimated_time,
+            'will_test': self.will_test,
+        }
+
+
+def get_plan_cost(tests, applied_config=None):
+    """
+    Get the cost of reconfiguring the testbed when running
+    the tests in the given order
+    """
+    cost = 0
+    config = applied_config
+    for test in tests:
+        if test.will_test:
+            cost += Testbed.get_setup_cost(config, test.config)
+            config = test.config
+    return cost
+
+
+def schedule_tree_order(tests, applied_config=None):
+    """
+    Run the tests in the order of the steps
+    """
+    return list(tests)
+
+
+def schedule_min_reconfiguration(tests, applied_config=None):
+    """
+    Run the tests so that the testbed is reconfigured as little as
+    possible, by always picking the test that is cheapest to set up
+    next. Tests costing the same are run in the order of the steps.
+    """
+    skipped = [test for test in tests if not test.will_test]
+    remaining = [test for test in tests if test.will_test]
+
+    ordered = []
+    config = applied_config
+    while len(remaining) > 0:
+        test = min(remaining, key=lambda test: Testbed.get_setup_cost(config, test.config))
+        remaining.remove(test)
+        ordered.append(test)
+        config = test.config
+
+    return skipped + ordered
+
+
+def save_plan(file, tests):
+    """
+    Store a description of the tests, so it can be inspected
+    or compared with a later run. It is not read back by the framework.
+    """
+    with open(file, 'w') as f:
+        json.dump([test.to_dict() for test in tests], f, indent=2)
+        f.write('\n')
+
+
+def get_plan_hash(tests):
+    """
+    Get a hash identifying the tests of a plan and their configuration,
+    not changed by the tests being run
+    """
+    plan = [{
+        'folder': test.collection.folder + '/test',
+        'test_fn': get_name(test.run_args['test_fn']),
+        'config_hash': test.state['testbed'].get_config_hash(),
+    } for test in tests]
+
+    return hashlib.sha1(json.dumps(plan, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+This module contains the timeline logic, recording how long each
+part of running, analyzing and plotting the tests takes
+
+Each span is written as a line of JSON to timeline.jsonl in the
+folder it belongs to (e.g. the test), and to the timeline of the
+campaign in the root folder while running tests. The lines are
+events in the Chrome trace format, and can be combined into a file
+for chrome://tracing or Perfetto by running this file:
+
+    ./timeline.py <folder> <output.json>
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+TIMELINE_FILE = 'timeline.jsonl'
+
+# the timeline of the campaign being run, set by run_test
+campaign_file = None
+
+lock = threading.Lock()
+
+
+def add_span(folder, name, category, start, end, **args):
+    """
+    Write a span to the timeline of a folder and the campaign
+
+    folder: Folder the span belongs to, or None to only add it to the campaign
+    start, end: Time as returned by time.time()
+    """
+    files = set()
+    if folder is not None and os.path.isdir(folder):
+        files.add(folder + '/' + TIMELINE_FILE)
+    if campaign_file is not None:
+        files.add(campaign_file)
+
+    event = json.dumps({
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': int(start * 1000000),
+        'dur': int((end - start) * 1000000),
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+        'args': args,
+    }, sort_keys=True)
+
+    with lock:
+        for file in files:
+            with open(file, 'a') as f:
+                f.write(event + '\n')
+
+
+@contextmanager
+def span(folder, name, category, **args):
+    """
+    Record the time of the enclosed code as a span
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_span(folder, name, category, start, time.time(), **args)
+
+
+def read_timeline(file):
+    with open(file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip() != '']
+
+
+def write_chrome_trace(folder, output_file):
+    """
+    Combine all timelines found in a folder into a
+    file in the Chrome trace format
+    """
+    events = []
+    seen = set()
+    for root, dirs, files in os.walk(folder):
+        if TIMELINE_FILE in files:
+            for event in read_timeline(root + '/' + TIMELINE_FILE):
+                # the campaign timeline repeats the events of the tests
+                key = json.dumps(event, sort_keys=True)
+                if key not in seen:
+                    seen.add(key)
+                    events.append(event)
+
+    events.sort(key=lambda event: event['ts'])
+
+    with open(output_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: %s <folder> <output_file>' % sys.argv[0])
+        sys.exit(1)
+    write_chrome_trace(sys.argv[1], sys.argv[2])
@@ -3,11 +3,44 @@ This file contains different functions for generating traffic for a test
 """
 
 import os
-from plumbum.cmd import ssh
 
 from . import logger
 from . import processes
+from .agent import get_agent
+from .ssh import get_ssh
 from .terminal import get_log_cmd
+from .testenv import get_test_folder
+
+
+def run_agent(dry_run, node_cmds):
+    """
+    Start commands on the nodes using the traffic agent
+
+    node_cmds: List of (node, list of commands), e.g. ('SERVERA', [...]).
+      The nodes are started in the given order and stopped in
+      the reverse order.
+
+    Returns a lambda to stop the traffic
+    """
+    for node, cmds in node_cmds:
+        for cmd in cmds:
+            logger.debug('agent %s: %s' % (node, cmd))
+
+    if dry_run:
+        def stop_test():
+            pass
+
+    else:
+        started = []
+        for node, cmds in node_cmds:
+            agent = get_agent(node)
+            started.append((agent, agent.start(cmds)))
+
+        def stop_test():
+            for agent, ids in reversed(started):
+                agent.stop(ids)
+
+    return stop_test
 
 
 def tcp_netcat(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
@@ -19,8 +52,8 @@ def tcp_netcat(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
 
     hint_fn('traffic=tcp type=netcat node=%s%s server=%d tag=%s' % (node, node, server_port, 'No-tag' if tag is None else tag))
 
-    cmd1 = ssh['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'cat /dev/zero | nc -l %d >/dev/null' % server_port]
-    cmd2 = ssh['-tt', os.environ['IP_CLIENT%s_MGMT' % node], 'sleep 0.2; nc -d %s %d >/dev/null' % (os.environ['IP_SERVER%s' % node], server_port)]
+    cmd1 = get_ssh()['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'cat /dev/zero | nc -l %d >/dev/null' % server_port]
+    cmd2 = get_ssh()['-tt', os.environ['IP_CLIENT%s_MGMT' % node], 'sleep 0.2; nc -d %s %d >/dev/null' % (os.environ['IP_SERVER%s' % node], server_port)]
 
     if dry_run:
         logger.debug(get_log_cmd(cmd1))
@@ -42,6 +75,27 @@ def tcp_netcat(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
     return stop_test
 
 
+def tcp_netcat_agent(dry_run, testbed, hint_fn, run_fn, node='a', flows=1, tag=None):
+    """
+    Run a number of TCP flows with netcat (nc) using the traffic agent
+
+    Works as the tcp_netcat method, but all flows are started by the
+    agent on the nodes in one batch, see greedy_agent
+    """
+    node = 'A' if node == 'a' else 'B'
+
+    cmds_server = []
+    cmds_client = []
+    for i in range(flows):
+        server_port = testbed.get_next_traffic_port('SERVER%s' % node)
+        hint_fn('traffic=tcp type=netcat node=%s%s server=%d tag=%s' % (node, node, server_port, 'No-tag' if tag is None else tag))
+
+        cmds_server.append('cat /dev/zero | nc -l %d >/dev/null' % server_port)
+        cmds_client.append('sleep 0.2; nc -d %s %d >/dev/null' % (os.environ['IP_SERVER%s' % node], server_port))
+
+    return run_agent(dry_run, [('SERVER%s' % node, cmds_server), ('CLIENT%s' % node, cmds_client)])
+
+
 def tcp_iperf(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
     """
     Run TCP traffic with iperf2
@@ -51,8 +105,8 @@ def tcp_iperf(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
 
     hint_fn('traffic=tcp type=iperf2 node=%s%s client=%d tag=%s' % (node, node, server_port, 'No-tag' if tag is None else tag))
 
-    cmd1 = ssh['-tt', os.environ['IP_CLIENT%s_MGMT' % node], 'iperf -s -p %d' % server_port]
-    cmd2 = ssh['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'sleep 0.2; iperf -c %s -p %d -t 86400' % (os.environ['IP_CLIENT%s' % node], server_port)]
+    cmd1 = get_ssh()['-tt', os.environ['IP_CLIENT%s_MGMT' % node], 'iperf -s -p %d' % server_port]
+    cmd2 = get_ssh()['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'sleep 0.2; iperf -c %s -p %d -t 86400' % (os.environ['IP_CLIENT%s' % node], server_port)]
 
     logger.debug(get_log_cmd(cmd1))
     logger.debug(get_log_cmd(cmd2))
@@ -73,6 +127,28 @@ def tcp_iperf(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
     return stop_test
 
 
+def tcp_iperf_agent(dry_run, testbed, hint_fn, run_fn, node='a', flows=1, tag=None):
+    """
+    Run a number of TCP flows with iperf2 using the traffic agent
+
+    Works as the tcp_iperf method, but all flows are started by the
+    agent on the nodes in one batch, see greedy_agent
+    """
+    node = 'A' if node == 'a' else 'B'
+
+    cmds_server = []
+    cmds_client = []
+    for i in range(flows):
+        server_port = testbed.get_next_traffic_port('CLIENT%s' % node)
+        hint_fn('traffic=tcp type=iperf2 node=%s%s client=%d tag=%s' % (node, node, server_port, 'No-tag' if tag is None else tag))
+
+        cmds_server.append('iperf -s -p %d' % server_port)
+        cmds_client.append('sleep 0.2; iperf -c %s -p %d -t 86400' % (os.environ['IP_CLIENT%s' % node], server_port))
+
+    # the iperf server runs on the client machine
+    return run_agent(dry_run, [('CLIENT%s' % node, cmds_server), ('SERVER%s' % node, cmds_client)])
+
+
 def scp(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
     """
     Run TCP traffic with SCP (SFTP)
@@ -94,7 +170,7 @@ def scp(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
 
     hint_fn('traffic=tcp type=scp node=%s%s server=%s tag=%s' % (node, node, server_port, 'No-tag' if tag is None else tag))
 
-    cmd = ssh['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'scp /opt/testbed/bigfile %s:/tmp/' % (os.environ['IP_CLIENT%s' % node])]
+    cmd = get_ssh()['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'scp /opt/testbed/bigfile %s:/tmp/' % (os.environ['IP_CLIENT%s' % node])]
 
     logger.debug(get_log_cmd(cmd))
     if dry_run:
@@ -127,7 +203,7 @@ def sshstream(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
 
     hint_fn('traffic=tcp type=ssh node=%s%s server=%s tag=%s' % (node, node, server_port, 'No-tag' if tag is None else tag))
 
-    cmd = ssh['-tt', os.environ['IP_SERVER%s_MGMT' % node],
+    cmd = get_ssh()['-tt', os.environ['IP_SERVER%s_MGMT' % node],
         """
         dd if=/dev/zero | ssh %s 'cat - >/dev/null'
         """ % (os.environ['IP_CLIENT%s' % node])
@@ -169,8 +245,8 @@ def greedy(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
 
     hint_fn('traffic=tcp type=greedy node=%s%s server=%s tag=%s' % (node, node, server_port, 'No-tag' if tag is None else tag))
 
-    cmd1 = ssh['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'greedy -vv -s %d' % server_port]
-    cmd2 = ssh['-tt', os.environ['IP_CLIENT%s_MGMT' % node], 'sleep 0.2; greedy -vv %s %d' % (os.environ['IP_SERVER%s' % node], server_port)]
+    cmd1 = get_ssh()['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'greedy -vv -s %d' % server_port]
+    cmd2 = get_ssh()['-tt', os.environ['IP_CLIENT%s_MGMT' % node], 'sleep 0.2; greedy -vv %s %d' % (os.environ['IP_SERVER%s' % node], server_port)]
 
     logger.debug(get_log_cmd(cmd1))
     logger.debug(get_log_cmd(cmd2))
@@ -191,6 +267,89 @@ def greedy(dry_run, testbed, hint_fn, run_fn, node='a', tag=None):
     return stop_test
 
 
+def greedy_agent(dry_run, testbed, hint_fn, run_fn, node='a', flows=1, tag=None):
+    """
+    Run a number of greedy TCP flows using the traffic agent
+
+    Works as the greedy method, but instead of running two SSH
+    processes for each flow all flows are started by the agent
+    on the nodes in one batch. Use this when running many flows.
+
+    Requires bin/aqmt-traffic-agent on the machines, see agent.py
+
+    node: a or b (a is normally classic traffic, b is normally l4s)
+    flows: Number of flows
+
+    Returns a lambda to stop the traffic
+    """
+    node = 'A' if node == 'a' else 'B'
+
+    cmds_server = []
+    cmds_client = []
+    for i in range(flows):
+        server_port = testbed.get_next_traffic_port('SERVER%s' % node)
+        hint_fn('traffic=tcp type=greedy node=%s%s server=%s tag=%s' % (node, node, server_port, 'No-tag' if tag is None else tag))
+
+        cmds_server.append('greedy -vv -s %d' % server_port)
+        cmds_client.append('sleep 0.2; greedy -vv %s %d' % (os.environ['IP_SERVER%s' % node], server_port))
+
+    return run_agent(dry_run, [('SERVER%s' % node, cmds_server), ('CLIENT%s' % node, cmds_client)])
+
+
+def short_flows(dry_run, testbed, hint_fn, run_fn, node='a', arrival_rate=10, sizes='10000:0.7,100000:0.2,1000000:0.1', tag=None):
+    """
+    Run short TCP transfers from the server to the client,
+    e.g. to simulate web traffic
+
+    Requires bin/aqmt-short-flows on the machines
+
+    The transfers arrive as a Poisson process, and the size of
+    each transfer is drawn from a given distribution. The flow
+    completion time of each transfer is stored in the test folder
+    in fct/<server port>, see calc_fct.py.
+
+    node: a or b (a is normally classic traffic, b is normally l4s)
+    arrival_rate: Average number of new transfers each second
+    sizes: Comma separated list of <bytes>:<weight>
+
+    Tagging makes it possible to map similar traffic from multiple tests,
+    despite being different ports and setup
+
+    Returns a lambda to stop the traffic
+    """
+    node = 'A' if node == 'a' else 'B'
+    server_port = testbed.get_next_traffic_port('SERVER%s' % node)
+
+    hint_fn('traffic=tcp type=short node=%s%s server=%s arrival_rate=%s sizes=%s tag=%s' % (
+        node, node, server_port, arrival_rate, sizes, 'No-tag' if tag is None else tag))
+
+    cmd1 = get_ssh()['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'aqmt-short-flows server %d' % server_port]
+    cmd2 = get_ssh()['-tt', os.environ['IP_CLIENT%s_MGMT' % node], 'sleep 0.2; aqmt-short-flows client %s %d %s %s' % (
+        os.environ['IP_SERVER%s' % node], server_port, arrival_rate, sizes)]
+
+    logger.debug(get_log_cmd(cmd1))
+    logger.debug(get_log_cmd(cmd2))
+    if dry_run:
+        def stop_test():
+            pass
+
+    else:
+        fct_folder = get_test_folder() + '/fct'
+        if not os.path.exists(fct_folder):
+            os.makedirs(fct_folder)
+
+        pid_server = run_fn(cmd1)
+        pid_client = run_fn(cmd2 > '%s/%d' % (fct_folder, server_port))
+        processes.add_known_pid(pid_server)
+        processes.add_known_pid(pid_client)
+
+        def stop_test():
+            processes.kill_pid(pid_client)
+            processes.kill_pid(pid_server)
+
+    return stop_test
+
+
 def udp(dry_run, testbed, hint_fn, run_fn, bitrate, node='a', ect="nonect", tag=None):
     """
     Run UDP traffic at a constant bitrate
@@ -216,7 +375,7 @@ def udp(dry_run, testbed, hint_fn, run_fn, bitrate, node='a', ect="nonect", tag=
 
     hint_fn('traffic=udp node=%s%s client=%s rate=%d ect=%s tag=%s' % (node, node, server_port, bitrate, ect, 'No-tag' if tag is None else tag))
 
-    cmd_server = ssh['-tt', os.environ['IP_CLIENT%s_MGMT' % node], 'iperf -s -p %d' % server_port]
+    cmd_server = get_ssh()['-tt', os.environ['IP_CLIENT%s_MGMT' % node], 'iperf -s -p %d' % server_port]
 
     # bitrate to iperf is the udp data bitrate, not the ethernet frame size as we want
     framesize = 1514
@@ -224,7 +383,7 @@ def udp(dry_run, testbed, hint_fn, run_fn, bitrate, node='a', ect="nonect", tag=
     length = framesize - headers
     bitrate = bitrate * length / framesize
 
-    cmd_client = ssh['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'sleep 0.5; iperf -c %s -p %d %s -u -l %d -R -b %d -i 1 -t 99999' % (
+    cmd_client = get_ssh()['-tt', os.environ['IP_SERVER%s_MGMT' % node], 'sleep 0.5; iperf -c %s -p %d %s -u -l %d -R -b %d -i 1 -t 99999' % (
         os.environ['IP_CLIENT%s' % node],
         server_port,
         tos,
@@ -250,3 +409,46 @@ def udp(dry_run, testbed, hint_fn, run_fn, bitrate, node='a', ect="nonect", tag=
             processes.kill_pid(pid_server)
 
     return stop_test
+
+
+def udp_agent(dry_run, testbed, hint_fn, run_fn, bitrate, node='a', ect="nonect", flows=1, tag=None):
+    """
+    Run a number of UDP flows each at a constant bitrate using the traffic agent
+
+    Works as the udp method, but all flows are started by the
+    agent on the nodes in one batch, see greedy_agent
+    """
+
+    tos = ''
+    if ect == 'ect1':
+        tos = "--tos 0x01"  # ECT(1)
+    elif ect == 'ect0':
+        tos = "--tos 0x02"  # ECT(0)
+    else:
+        ect = 'nonect'
+
+    node = 'A' if node == 'a' else 'B'
+
+    # bitrate to iperf is the udp data bitrate, not the ethernet frame size as we want
+    framesize = 1514
+    headers = 42
+    length = framesize - headers
+    iperf_bitrate = bitrate * length / framesize
+
+    cmds_server = []
+    cmds_client = []
+    for i in range(flows):
+        server_port = testbed.get_next_traffic_port('CLIENT%s' % node)
+        hint_fn('traffic=udp node=%s%s client=%s rate=%d ect=%s tag=%s' % (node, node, server_port, bitrate, ect, 'No-tag' if tag is None else tag))
+
+        cmds_server.append('iperf -s -p %d' % server_port)
+        cmds_client.append('sleep 0.5; iperf -c %s -p %d %s -u -l %d -R -b %d -i 1 -t 99999' % (
+            os.environ['IP_CLIENT%s' % node],
+            server_port,
+            tos,
+            length,
+            iperf_bitrate
+        ))
+
+    # the iperf server runs on the client machine
+    return run_agent(dry_run, [('CLIENT%s' % node, cmds_server), ('SERVER%s' % node, cmds_client)])
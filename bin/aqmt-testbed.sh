@@ -27,6 +27,11 @@ ip() {
     fi
 }
 
+# use the connections kept open while running tests (see aqmt/ssh.py)
+ssh() {
+    command ssh $AQMT_SSH_OPTIONS "$@"
+}
+
 configure_host_cc() {(set -e
     local host=$1
     local tcp_congestion_control=$2
@@ -207,6 +212,18 @@ reset_aqm_server_edge() {(set -e
     done
 )}
 
+reset_server_edge() {(set -e
+    local ip_server_mgmt=$1
+    local iface_server=$2
+    local iface_on_server=$3
+
+    # reset qdisc for a single server, at both sides of the link
+    tc qdisc del dev $iface_server root 2>/dev/null || true
+    tc qdisc add dev $iface_server root handle 1: pfifo_fast 2>/dev/null || true
+
+    reset_host $ip_server_mgmt $iface_on_server
+)}
+
 reset_host() {(set -e
     local host=$1
     local iface=$2 # the iface is the one that test traffic to aqm is going on
@@ -254,14 +271,21 @@ set_offloading() {(set -e
     done
 )}
 
+kill_traffic() {(set -e
+    local host=$1
+
+    ssh root@$host '
+        set -e
+        killall -9 iperf 2>/dev/null || :
+        killall -9 greedy 2>/dev/null || :
+        pkill -9 -f "[a]qmt-short-flows" 2>/dev/null || :'
+)}
+
 kill_all_traffic() {(set -e
     hosts=($IP_CLIENTA_MGMT $IP_CLIENTB_MGMT $IP_SERVERA_MGMT $IP_SERVERB_MGMT)
 
     for host in ${hosts[@]}; do
-        ssh root@$host '
-            set -e
-            killall -9 iperf 2>/dev/null || :
-            killall -9 greedy 2>/dev/null || :'
+        kill_traffic $host
     done
 )}
 
@@ -301,6 +325,24 @@ check_port_in_use() {(set -e
         "
 )}
 
+get_ports_in_use() {(set -e
+    # output to stdout: the local ports of all tcp and udp sockets, one per line
+    local host=$1
+
+    ssh root@$host "
+        set -e
+        ss -antu | tail -n +2 | awk '{print \$5}' | sed 's/.*://' | sort -un
+        "
+)}
+
+get_qdisc_backlog() {(set -e
+    # output to stdout: the number of packets queued in the root qdisc
+    # (including its children) of the given interfaces on this node
+    for iface in "$@"; do
+        tc -s qdisc show dev $iface root
+    done | grep -o 'backlog [^ ]* [0-9]*p' | awk '{ sum += $3 } END { print sum + 0 }'
+)}
+
 get_aqm_options() {(set -e
     local aqm_name=$1
 